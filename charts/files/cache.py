@@ -0,0 +1,66 @@
+try:
+  import logging
+  import threading
+  import time
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+DEFAULTREFRESH = 30
+
+# /
+  # Description: In-memory copy of the cluster state used to answer questions without calling the API server.
+  #   Nodes and pods are held in the TopologyIndex, PVs and PVCs are held here. The lock must be held by anything
+  #   reading or changing the state. It is only held while the state is read or changed, never while the API server
+  #   is called, so the scheduling loop, the refresh, plans and configuration reloads do not hold each other up.
+  #
+  # Inputs:
+  #   apiClient: The API gateway used to refresh the state
+  #   topology: TopologyIndex of the nodes and pods
+  #   namespace: Kubernetes namespace of the PVCs
+# /
+class ClusterCache(object):
+
+  def __init__(self, apiClient, topology, namespace):
+    self.apiClient = apiClient
+    self.topology = topology
+    self.namespace = namespace
+    self.lock = threading.RLock()
+    # PV name -> V1PersistentVolume
+    self.pvs = {}
+    # PVC name -> V1PersistentVolumeClaim
+    self.pvcs = {}
+    self.refreshed = None
+
+  # /
+    # Description: Refresh the nodes, PVs and PVCs from the API server.
+  # /
+  def refresh(self):
+    nodes = self.apiClient.list_node()
+    pvs = self.apiClient.list_persistent_volume()
+    pvcs = self.apiClient.list_namespaced_persistent_volume_claim(self.namespace)
+    with self.lock:
+      self.topology.syncNodes(nodes.items)
+      self.pvs = dict((pv.metadata.name, pv) for pv in pvs.items)
+      self.pvcs = dict((pvc.metadata.name, pvc) for pvc in pvcs.items)
+      self.refreshed = time.time()
+    logging.debug("Cluster cache refreshed: %s nodes, %s PVs, %s PVCs" % (len(nodes.items), len(self.pvs), len(self.pvcs)))
+
+  # /
+    # Description: Refresh the cache in a background thread.
+    #
+    # Inputs:
+    #   interval: Seconds between refreshes
+  # /
+  def start(self, interval = DEFAULTREFRESH):
+    def refreshLoop():
+      while True:
+        try:
+          self.refresh()
+        except Exception as e:
+          logging.error("Cluster cache refresh failed: %s" % e)
+        time.sleep(interval)
+    thread = threading.Thread(target = refreshLoop, name = 'cache')
+    thread.daemon = True
+    thread.start()
@@ -0,0 +1,112 @@
+try:
+  import collections
+  import logging
+  import os
+  import sys
+  import threading
+  import time
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+DEFAULTINTERVAL = 0.01
+DEFAULTSIZE = 256
+MAXSAMPLESECONDS = 60
+MININTERVAL = 0.001
+TOPSCORES = 5
+
+# /
+  # Description: Bounded in-memory record of the most recent scheduling decisions. Recording a decision only appends
+  #   a small dictionary, the entries are only formatted when someone asks for them.
+  #
+  # Inputs:
+  #   size: Number of decisions to keep
+  #   apiCalls: Function returning the number of calls of each API method made by the calling thread, or None. Only
+  #     the calls of the thread making the decision are counted, not those of e.g. the cluster cache refresh.
+# /
+class FlightRecorder(object):
+
+  def __init__(self, size = DEFAULTSIZE, apiCalls = None):
+    self.decisions = collections.deque(maxlen = size)
+    self.apiCalls = apiCalls
+
+  # /
+    # Description: Returns the API call counts to pass to `record` once the decision is made.
+  # /
+  def begin(self):
+    if self.apiCalls is None:
+      return {}
+    return self.apiCalls()
+
+  # /
+    # Description: Record a decision.
+    #
+    # Inputs:
+    #   decision: Dictionary describing the decision
+    #   apiBefore: API call counts from `begin`
+  # /
+  def record(self, decision, apiBefore):
+    if self.apiCalls is not None:
+      decision['apiCalls'] = dict((name, calls - apiBefore.get(name, 0)) for name, calls in self.apiCalls().items() if calls != apiBefore.get(name, 0))
+    self.decisions.append(decision)
+
+  # /
+    # Description: Returns the recorded decisions, newest first.
+    #
+    # Inputs:
+    #   limit: Maximum number of decisions to return
+    #   pod: Only return decisions for this pod
+  # /
+  def recent(self, limit = None, pod = None):
+    # copy first, the scheduling loop appends while the HTTP server reads
+    decisions = [d for d in reversed(list(self.decisions)) if pod is None or d['pod'] == pod]
+    return decisions[:limit] if limit else decisions
+
+# /
+  # Description: Returns the best scores of a decision for the flight recorder.
+  #
+  # Inputs:
+  #   nodes: Node names ordered best first
+  #   context: SchedulingContext of the decision
+# /
+def topScores(nodes, context):
+  scores = []
+  for name in nodes[:TOPSCORES]:
+    slot = context.topology.slots.get(name)
+    if slot in context.scores:
+      scores.append({"node": name, "score": float(context.scores[slot])})
+  return scores
+
+# /
+  # Description: Samples the stack of a thread at a fixed interval, in the style of py-spy, and returns the stacks in
+  #   the collapsed format used for flame graphs (`outermost;...;innermost count`), most frequent first.
+  #   Nothing is collected unless this is called.
+  #
+  # Inputs:
+  #   threadId: Identifier of the thread to sample, the main (scheduling) thread by default
+  #   seconds: How long to sample for
+  #   interval: Seconds between samples, at least MININTERVAL so the sampling does not take the interpreter lock from the
+  #     thread being sampled
+# /
+def sampleStacks(threadId = None, seconds = 5, interval = DEFAULTINTERVAL):
+  if threadId is None:
+    threadId = threading.main_thread().ident
+  seconds = min(float(seconds), MAXSAMPLESECONDS)
+  interval = max(float(interval), MININTERVAL)
+  counts = collections.Counter()
+  samples = 0
+  end = time.time() + seconds
+  while time.time() < end:
+    frame = sys._current_frames().get(threadId)
+    if frame is None:
+      break
+    stack = []
+    while frame is not None:
+      stack.append("%s:%s:%d" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name, frame.f_lineno))
+      frame = frame.f_back
+    counts[';'.join(reversed(stack))] += 1
+    samples += 1
+    time.sleep(interval)
+  logging.info("Sampled %s stacks over %ss" % (samples, seconds))
+  return '\n'.join("%s %d" % (stack, count) for stack, count in counts.most_common()) + '\n'
@@ -0,0 +1,142 @@
+try:
+  import logging
+  import socket
+  import threading
+  import time
+  from urllib3.exceptions import HTTPError
+  from kubernetes import client
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+DEFAULTBURST = 30
+DEFAULTPOOLSIZE = 4
+DEFAULTQPS = 20
+DEFAULTTIMEOUT = 30
+
+# /
+  # Description: Token bucket used to limit the rate of calls to the API server. Up to `burst` calls can be made
+  #   at once, after which calls are limited to `qps` per second.
+  #
+  # Inputs:
+  #   qps: Sustained calls per second
+  #   burst: Maximum number of calls that can be made at once
+# /
+class TokenBucket(object):
+
+  def __init__(self, qps, burst):
+    self.qps = float(qps)
+    self.burst = float(burst)
+    self.tokens = self.burst
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  # /
+    # Description: Take a token, waiting until one is available. Returns the time spent waiting in seconds.
+  # /
+  def acquire(self):
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.qps)
+      self.last = now
+      wait = 0
+      if self.tokens < 1:
+        wait = (1 - self.tokens) / self.qps
+        time.sleep(wait)
+        self.tokens = 1
+        self.last = time.time()
+      self.tokens -= 1
+      return wait
+
+# /
+  # Description: Single gateway for all calls to the Kubernetes API server. Holds long lived Core and Apps API
+  #   clients sharing one tuned connection pool, limits the call rate with a token bucket, applies a timeout to
+  #   every call, raises timeouts and connection errors as an ApiException with status 0 and keeps a count,
+  #   error count and total time for each API method.
+  #   API methods are called on the gateway directly, e.g. `gateway.list_node()`.
+  #
+  # Inputs:
+  #   qps: Sustained calls per second
+  #   burst: Maximum number of calls that can be made at once
+  #   timeout: Timeout in seconds for each call
+  #   poolSize: Maximum number of connections kept to the API server
+# /
+class ApiGateway(object):
+
+  def __init__(self, qps = DEFAULTQPS, burst = DEFAULTBURST, timeout = DEFAULTTIMEOUT, poolSize = DEFAULTPOOLSIZE):
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = poolSize
+    self.apiClient = client.ApiClient(configuration)
+    self.core = client.CoreV1Api(self.apiClient)
+    self.apps = client.AppsV1Api(self.apiClient)
+    self.bucket = TokenBucket(qps, burst)
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.calls = {}
+    # method name -> calls made by the thread, per thread
+    self.threadLocal = threading.local()
+    logging.info("API gateway: qps: %s, burst: %s, timeout: %ss, pool size: %s" % (qps, burst, timeout, poolSize))
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    for api in (self.core, self.apps):
+      method = getattr(api, name, None)
+      if method is not None:
+        break
+    else:
+      raise AttributeError(name)
+    def gatewayCall(*args, **kwargs):
+      waited = self.bucket.acquire()
+      kwargs.setdefault('_request_timeout', self.timeout)
+      start = time.time()
+      failed = False
+      try:
+        return method(*args, **kwargs)
+      except client.rest.ApiException:
+        failed = True
+        raise
+      except (HTTPError, socket.timeout) as e:
+        # timeouts and connection errors are raised as an ApiException so callers only handle the one exception
+        failed = True
+        raise client.rest.ApiException(status = 0, reason = "%s: %s" % (type(e).__name__, e))
+      finally:
+        self.account(name, time.time() - start, waited, failed)
+    return gatewayCall
+
+  # /
+    # Description: Record a call in the call accounting.
+    #
+    # Inputs:
+    #   name: Name of the API method
+    #   elapsed: Time the call took in seconds
+    #   waited: Time spent waiting for the rate limit in seconds
+    #   failed: True if the call raised an ApiException, timed out or could not connect
+  # /
+  def account(self, name, elapsed, waited, failed):
+    with self.lock:
+      stats = self.calls.setdefault(name, {"calls": 0, "errors": 0, "seconds": 0.0, "throttled": 0.0})
+      stats['calls'] += 1
+      stats['seconds'] += elapsed
+      stats['throttled'] += waited
+      if failed:
+        stats['errors'] += 1
+    threadCalls = getattr(self.threadLocal, 'calls', None)
+    if threadCalls is None:
+      threadCalls = self.threadLocal.calls = {}
+    threadCalls[name] = threadCalls.get(name, 0) + 1
+    logging.debug("API call %s took %.3fs (throttled %.3fs)" % (name, elapsed, waited))
+
+  # /
+    # Description: Returns a copy of the call accounting, keyed by API method.
+  # /
+  def stats(self):
+    with self.lock:
+      return dict((name, dict(stats)) for name, stats in self.calls.items())
+
+  # /
+    # Description: Returns the number of calls of each API method made by the calling thread.
+  # /
+  def threadCalls(self):
+    return dict(getattr(self.threadLocal, 'calls', {}))
@@ -1,5 +1,6 @@
 try:
   import decimal
+  import json
   import re
   import logging
 except ImportError as e:
@@ -97,4 +98,16 @@ def cleanMultiples(pvpvcList):
         break
   for i in finalMap:
     logging.info("PVC %s, PV: %s" % (i['pvc'].metadata.name, i['pv'].metadata.name))
-  return finalMap
\ No newline at end of file
+  return finalMap
+
+# /
+  # Desccription: Returns the message of an ApiException, from the Status in its body if there is one
+  #
+  # Inputs:
+  #   e: ApiException, the body is None for timeouts and connection errors
+# /
+def apiErrorMessage(e):
+  try:
+    return json.loads(e.body)['message']
+  except (TypeError, ValueError, KeyError):
+    return e.reason
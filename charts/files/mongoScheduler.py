@@ -1,19 +1,30 @@
 try:
+  import startup
+  import argparse
+  import atexit
+  import cache
+  import collections
+  import copy
+  import debug
   import os
   import json
   import logging
   import random
+  import recorder
+  import reservation
+  import reloader
+  import server
+  import signal
+  import threading
+  import time
   import helpers
-  import copy
+  import gateway
+  import pipeline
   import re
-  from kubernetes import client, config, watch
-  from kubernetes.utils import parse_quantity
-  from kubernetes.client.rest import ApiException
-  from kubernetes.client.models.v1_persistent_volume_list import V1PersistentVolumeList
-  from kubernetes.client.models.v1_node_list import V1NodeList
-  from kubernetes.client.models.v1_pod_list import V1PodList
+  import topology
+  from kubernetes import client, config, utils, watch
   from time import sleep
-  from yaml import safe_load
+  import yaml
 except ImportError as e:
   print(e)
   exit(1)
@@ -24,24 +35,33 @@ ANTIAFFINITY = 1
 AVAILABLE = "Available"
 BOUND = "Bound"
 DOESNOTEXIST = "DoesNotExist"
+DONOTSCHEDULE = "DoNotSchedule"
 EXISTS = "Exists"
 IN = "In"
+HOSTNAME = "kubernetes.io/hostname"
+MAXBOUNDNODES = 8
 MAXCOUNT = 5
+MAXMANIFESTS = 32
+MAXPVAFFINITY = 1024
 NOTIN = "NotIn"
 PENDING = "Pending"
+PLANNED = "%s (planned)"
+# configuration settings only read at start up
+RESTARTKEYS = ["namespace", "recordFile", "httpPort", "httpAddress", "cacheRefresh", "configReload", "flightRecorderSize", "reservationTTL", "apiQPS", "apiBurst", "apiTimeout", "apiPoolSize"]
+ZONE = "topology.kubernetes.io/zone"
 
 # /
   # Description: function to determine the number of replicas and the PVCs in the statefulSet.
   #
   # Inputs:
+  #   apiClient: The API gateway
   #   stateful_set: The name of the satefulSet
   #   namespace: The name of the Kubernetes namespace
 # /
-def statefulSetCheck(stateful_set, namespace):
+def statefulSetCheck(apiClient, stateful_set, namespace):
   replicas = None
   pvcs = None
-  ssClient = client.AppsV1Api()
-  statefulSets = ssClient.list_namespaced_stateful_set(namespace = namespace).items
+  statefulSets = apiClient.list_namespaced_stateful_set(namespace = namespace).items
   for n in statefulSets:
     if n.metadata.name == stateful_set:
       replicas = n.spec.replicas
@@ -50,24 +70,18 @@ def statefulSetCheck(stateful_set, namespace):
   return replicas, pvcs
 
 # /
-  # Description: function to determine the available nodes in a data centre.
+  # Description: function to refresh the node array of the topology index with the current nodes.
   #
   # Inputs:
-  #   apiClient: The object for the Kubernetes API
-  #   dataCentre: The name of the data centre of interest, this is a value of a selected label
-  #   dataCentresLabel: Node label to compare for `dataCentre`
+  #   apiClient: The API gateway
+  #   topology: TopologyIndex holding the node array
+  #   lock: Lock held while the topology index is changed
 # /
-def nodes_available(dataCentre, apiClient, dataCentresLabel):
-  goodNodes = V1NodeList(items = [])
+def refreshNodes(apiClient, topology, lock):
   nodes = apiClient.list_node()
-  for node in nodes.items:
-    logging.debug("Node: %s" % node.metadata.name)
-    if dataCentresLabel in node.metadata.labels and node.metadata.labels[dataCentresLabel] == dataCentre:
-      for status in node.status.conditions:
-        if status.status == "True" and status.type == "Ready":
-          goodNodes.items.append(node)
-          logging.debug("Adding node: %s" % node.metadata.name)
-  return goodNodes
+  with lock:
+    topology.syncNodes(nodes.items)
+  logging.debug("Nodes: %s, ready: %s" % (pipeline.count(topology.allMask), pipeline.count(topology.readyMask)))
 
 # /
   # Description: function to determine the data centres to use for the pod.
@@ -76,8 +90,11 @@ def nodes_available(dataCentre, apiClient, dataCentresLabel):
   #   podName: The name of the pod
   #   replicas: The number of replicas in the statefulSet
   #   dataCentres: An array of data centre names, this is a value of a selected label
+  #   chooser: Source of the random choice of the non-electable data centre, `random` by default
+  #   freeCapacity: Function returning the free capacity of a data centre, the non-electable data centre is chosen
+  #     among those with the most free capacity. If None the choice is only random
 # /
-def findDC(podName, replicas, primaryDataCentres, noPrimaryDataCentres):
+def findDC(podName, replicas, primaryDataCentres, noPrimaryDataCentres, chooser = random, freeCapacity = None):
   increment = podName.split('-')[-1]
   logging.debug("Increment: %s" % increment)
   if int(increment) != (int(replicas) - 1):
@@ -85,9 +102,59 @@ def findDC(podName, replicas, primaryDataCentres, noPrimaryDataCentres):
     dataCentre = primaryDataCentres[int(increment) % (len(primaryDataCentres))]
   else:
     logging.debug("Non-primary  pod")
-    dataCentre = random.choice(noPrimaryDataCentres)
+    choices = noPrimaryDataCentres
+    if freeCapacity is not None:
+      capacity = dict((dc, freeCapacity(dc)) for dc in noPrimaryDataCentres)
+      logging.debug("Free capacity of non-primary data centres: %s" % capacity)
+      choices = [dc for dc in noPrimaryDataCentres if capacity[dc] == max(capacity.values())]
+    dataCentre = chooser.choice(choices)
   return dataCentre
 
+# /
+  # Description: function to calculate the free resource score of a node for a pod, the sum of the fractions of CPU and
+  #   memory left once the pod is placed. Returns None if the pod does not fit on the node.
+  #
+  # Inputs:
+  #   node: Node object
+  #   committedCPU: CPU already committed on the node
+  #   committedMem: Memory already committed on the node
+  #   requestedCPU: CPU requested by the pod
+  #   requestedMem: Memory requested by the pod
+# /
+def nodeFreeScore(node, committedCPU, committedMem, requestedCPU, requestedMem):
+  cpu = helpers.checkCpuString(node.status.capacity['cpu'])
+  mem = utils.parse_quantity(node.status.capacity['memory'])
+  freeCPU = cpu - committedCPU - requestedCPU
+  freeMem = mem - committedMem - requestedMem
+  score = (freeCPU / cpu) + (freeMem / mem)
+  logging.debug("Score for %s: %s" % (node.metadata.name, score))
+  if score <= 0 or freeCPU < 0 or freeMem < 0:
+    return None
+  return score
+
+# /
+  # Description: function to calculate the free capacity of a data centre for a pod, the sum of the free resource scores
+  #   of the ready nodes in the data centre the pod fits on.
+  #
+  # Inputs:
+  #   dataCentre: Name of the data centre
+  #   podTopology: TopologyIndex holding the node array
+  #   ledger: ResourceLedger of the resources committed on each node
+  #   iCfg: The scheduler configuration
+  #   requestedCPU: CPU requested by the pod
+  #   requestedMem: Memory requested by the pod
+  #   exclude: Names of pods not counted against the nodes
+# /
+def dataCentreCapacity(dataCentre, podTopology, ledger, iCfg, requestedCPU, requestedMem, exclude):
+  capacity = 0
+  for slot in pipeline.bits(podTopology.domainMask(iCfg['dataCentresLabel'], dataCentre) & podTopology.readyMask):
+    node = podTopology.nodeAt(slot)
+    committedCPU, committedMem = ledger.committed(node.metadata.name, exclude)
+    score = nodeFreeScore(node, committedCPU, committedMem, requestedCPU or 0, requestedMem or 0)
+    if score is not None:
+      capacity += score
+  return capacity
+
 # /
   # Description: function to get the current deployed pods for the statefulSet and record which nodes they are running on
   #   for affinty/antiaffinity purposes.
@@ -108,129 +175,6 @@ def getSSPods(pods, searchKey, searchValue):
   return ssPods
 
 
-# /
-  # Description: function to get the current deployed pods and record which nodes they are running on
-  #   for affinty/antiaffinity purposes.
-  #
-  # Inputs:
-  #   bindingName: The name of the pod
-  #   nodeName: The name of the node to assign to
-  #   pods: podList of pods
-  #   namespace: The name of the Kubernetes namespace
-# /
-def getAllPods(apiClient, namespace):
-  runningPods = V1PodList(items = [])
-  allPods = apiClient.list_namespaced_pod(namespace = namespace)
-  for pod in allPods.items:
-    if pod.status.phase == "Running":
-      runningPods.items.append(pod)
-  logging.debug("All Pods: %s" % runningPods)
-
-  return runningPods
-
-# /
-  # Desccription: function determines what nodes satisfies pod affinity and antoaffinty
-  #
-  # Inputs:
-  #   affinityObject: Pod's affinity objects
-  #   targetPod: pod of interest
-  #   pods: List of pods to compare against for affinifty and antaffinity
-  #   node: Node to check
-  #   topologyKey: Topology key to check against the pod for the node
-  #   affinityType: AFFINITY or ANTIAFFINITY
-# /
-def sortPodAffinity(affinityObject, targetPod, pods, node, topologyKey, affinityType):
-  logging.info("Starting affinity/antiaffinity for pod %s and node %s" % (targetPod, node.metadata.name))
-  logging.debug("Toplogoy key: %s" % node.metadata.labels[topologyKey])
-  suitableNode = False
-  logging.debug(affinityObject.label_selector.match_expressions)
-  for expressions in affinityObject.label_selector.match_expressions:
-    logging.debug("EXPRESSIONS.key: %s EXPRESSIONS.operator: %s EXPRESSIONS.value: %s" % (expressions.key, expressions.operator, expressions.values))
-    if expressions.operator == IN:
-      logging.debug("IN")
-      for pod in pods.items:
-        logging.debug("POD: %s. LABELS: %s" % (pod.metadata.name, pod.metadata.labels))
-        if expressions.key in pod.metadata.labels and pod.metadata.labels[expressions.key] in expressions.values:
-          logging.debug("Key found: %s on %s" % (expressions.key, pod.metadata.name))
-          if node.metadata.labels[topologyKey] == pod.spec.node_name:
-            logging.debug("Node matches pod key, was %s" % pod.spec.node_name)
-            if affinityType == ANTIAFFINITY:
-              return False
-            else:
-              suitableNode = True
-              break
-          else:
-            logging.debug("Node does not match pod key, was %s" % pod.spec.node_name)
-            if affinityType == ANTIAFFINITY:
-              suitableNode = True
-              break
-        else:
-          logging.debug("Key NOT found: %s on %s" % (expressions.key, pod.metadata.name))
-          if affinityType == ANTIAFFINITY:
-            suitableNode = True
-            break
-          continue
-    elif expressions.operator == NOTIN:
-      for pod in pods.items:
-        if expressions.key in pod.metadata.labels and pod.metadata.labels[expressions.key] not in expressions.value:
-          if node.metadata.labels[topologyKey] == pod.spec.node_name:
-            if affinityType == ANTIAFFINITY:
-              return False
-            else:
-              suitableNode = True
-              break
-          else:
-            if affinityType == ANTIAFFINITY:
-              suitableNode = True
-              break
-        else:
-          logging.info("Key NOT found: %s on %s" % (expressions.key, pod.metadata.name))
-          if affinityType == ANTIAFFINITY:
-            suitableNode = True
-            break
-          continue
-    #elif expressions.operator == EXISTS:
-    #  for pod in pods:
-    #    if expressions.key in pod.metadata.labels:
-    #      if node.metadata[.topologyKey] == pod.spec.node_name:
-    #        if affinityType == ANTIAFFINITY:
-    #          return False
-    #        else:
-    #          selectedNodes = True
-    #    else:
-    #      if affinityType == AFFINITY:
-    #        selectedNodes = []
-    #        return selectedNodes
-    #elif expressions.operator == DOESNOTEXIST:
-    #  if expressions.key not in pod.metadata.labels:
-    #    if affinityType == ANTIAFFINITY:
-    #      selectedNodes = [node for node in selectedNodes if node.metadata.name != topologyKey]
-    #    else:
-    #      selectedNodes.extend(node for node in nodes if node.metadata.name == topologyKey)
-    #  else:
-    #    if affinityType == AFFINITY:
-    #      selectedNodes = []
-    #      return selectedNodes
-#         elif expressions.operator == 'Gt':
-#           for labels in pod.metadata.labels:
-#             if node.metadata[expressions.key] > expressions.value:
-#               if affinityType == 'antiaffinity':
-#                 selectedNodes.pop(selectedNodes.index(selectedNodes.index(next(node for node in nodes if node['hostname'] == topologyKey))))
-#               else:
-#                 selectedNodes.append(selectedNodes.index(next(node for node in nodes if node['hostname'] == topologyKey)))
-#         elif expressions.operator == 'Lt':
-#           for labels in pod.metadata.labels:
-#             if node.metadata[expressions.key] < expressions.value:
-#               if affinityType == 'antiaffinity':
-#                 selectedNodes.pop(selectedNodes.index(selectedNodes.index(next(node for node in nodes if node['hostname'] == topologyKey))))
-#               else:
-#                 selectedNodes.append(selectedNodes.index(next(node for node in nodes if node['hostname'] == topologyKey)))
-    else:
-      logging.warn("No valid operator for affinifty/anti-affinity")
-      return False
-    logging.debug("Returning: %s for node %s" % (str(suitableNode), node.metadata.name))
-  return suitableNode
-
 # /
   # Desccription: function determines what nodes satisfies node affinity and antoaffinty
   #
@@ -331,88 +275,60 @@ def checkNodeVolAffinity(pv, node):
               return False
   return passes_test
 
+# compiled PV node affinity by (PV name, resourceVersion), most recently used last
+PVAFFINITY = collections.OrderedDict()
+
 # /
-  # Description: Get the affinity and antiaffinity
+  # Description: Compiles the node affinity of a PV into a tuple of (key, operator, values) expressions, or None if the
+  #   PV has no node affinity. As with `checkNodeVolAffinity` every expression of every term must hold and at least one
+  #   must be present. PVs rarely change, so the compiled expressions are cached by resourceVersion.
   #
   # Inputs:
-  #   affinityObject: Pod's affinity objects
-  #   availableNodes: list of worker nodes that can be used
-  #   pods: List of pods in the namespace
-  #   pod: Name of pod
-# /
-def getAffinityNodes(affinityObject, availableNodes, pods, pod):
-  if affinityObject.pod_anti_affinity is not None:
-    if affinityObject.pod_anti_affinity.required_during_scheduling_ignored_during_execution is not None:
-      logging.debug(affinityObject.pod_anti_affinity.required_during_scheduling_ignored_during_execution)
-      for node in reversed(availableNodes.items):
-        for requiredRule in affinityObject.pod_anti_affinity.required_during_scheduling_ignored_during_execution:
-          logging.debug("REQUIRED ANTIAFFINITY RULE: %s" % requiredRule)
-          if requiredRule.label_selector.match_expressions is not None:
-            if requiredRule.topology_key != 'kubernetes.io/hostname':
-              logging.warn("Unknown `toplogyKey`")
-              continue
-            suitableNode = sortPodAffinity(requiredRule, pod, pods, node, requiredRule.topology_key, ANTIAFFINITY)
-            if suitableNode is True:
-              logging.info("Node %s is SUITABLE for pod Antiaffinity for pod %s" % (node.metadata.name, pod))
-            else:
-              logging.info("Node %s is NOT SUITABLE for pod Antiaffinity for pod %s" % (node.metadata.name, pod))
-              if node in availableNodes.items:
-                availableNodes.items.pop(availableNodes.items.index(node))
-        
-      if affinityObject.pod_anti_affinity.preferred_during_scheduling_ignored_during_execution is not None:
-        logging.warn("Preferred Pod Anti Affinity is ignored")
-        logging.debug(affinityObject.pod_anti_affinity.preferred_during_scheduling_ignored_during_execution)
-  for node in availableNodes.items:
-    logging.info("Remaining node: %s" % node.metadata.name)
-  if affinityObject.pod_affinity is not None:
-    if affinityObject.pod_affinity.required_during_scheduling_ignored_during_execution is not None:
-      logging.debug(affinityObject.pod_affinity.required_during_scheduling_ignored_during_execution)
-      for node in reversed(availableNodes.items):
-        for requiredRule in affinityObject.pod_affinity.required_during_scheduling_ignored_during_execution:
-          logging.debug("REQUIRED AFFINITY RULE: %s" % requiredRule)
-          if requiredRule.label_selector.match_expressions is not None:
-            if requiredRule.topology_key != 'kubernetes.io/hostname':
-              logging.warn("Unknown `toplogyKey`")
-              continue
-            suitableNode = sortPodAffinity(requiredRule, pod, pods, node, requiredRule.topology_key, AFFINITY)
-            if suitableNode is True:
-              logging.info("Node %s is SUITABLE for pod Affinity for pod %s" % (node.metadata.name, pod))
-            else:
-              logging.info("Node %s is NOT SUITABLE for pod Affinity for pod %s" % (node.metadata.name, pod))
-              if node in availableNodes.items:
-                availableNodes.items.pop(availableNodes.items.index(node))
-
-    if affinityObject.pod_affinity.preferred_during_scheduling_ignored_during_execution is not None:
-      logging.debug(affinityObject.pod_affinity.preferred_during_scheduling_ignored_during_execution)
-      logging.warn("Preferred Pod Anti Affinity is ignored")
-
-  return availableNodes
+  #   pv: PV to compile
+# /
+def compileVolAffinity(pv):
+  cacheKey = (pv.metadata.name, pv.metadata.resource_version)
+  if cacheKey in PVAFFINITY:
+    PVAFFINITY.move_to_end(cacheKey)
+    return PVAFFINITY[cacheKey]
+  expressions = None
+  if pv.spec.node_affinity is not None:
+    expressions = []
+    if pv.spec.node_affinity.required is not None:
+      for node_selector_term in pv.spec.node_affinity.required.node_selector_terms:
+        for expression in node_selector_term.match_expressions or []:
+          if expression.operator in (IN, NOTIN, EXISTS, DOESNOTEXIST):
+            expressions.append((expression.key, expression.operator, tuple(expression.values or ())))
+    expressions = tuple(expressions)
+  PVAFFINITY[cacheKey] = expressions
+  if len(PVAFFINITY) > MAXPVAFFINITY:
+    PVAFFINITY.popitem(last = False)
+  return expressions
 
 # /
-  # Description: Score the worker nodes for available resources
+  # Description: Returns the bitset of the nodes in the topology index that satisfy compiled PV node affinity.
   #
   # Inputs:
-  #   availableNodes: list of worker nodes that can be used
-  #   requestedCPU: Request CPU for the pod
-  #   requestedMem: request memoery for the pod
+  #   expressions: Expressions from `compileVolAffinity`
+  #   podTopology: TopologyIndex holding the node array
 # /
-def scoreNodes(availableNodes, requestedCPU, requestedMem):
-
-  if requestedCPU is None:
-    requestedCPU = 0
-  if requestedMem is None:
-    requestedMem = 0
-
-  for node in reversed(availableNodes.items):
-    cpu = helpers.checkCpuString(node.status.capacity['cpu'])
-    mem = parse_quantity(node.status.capacity['memory'])
-    node.metadata.labels['score'] = ((cpu - requestedCPU) / cpu) + ((mem - requestedMem) / mem)
-    logging.debug("Score for %s: %s" % (node.metadata.labels['kubernetes.io/hostname'], node.metadata.labels['score']))
-  
-    if node.metadata.labels['score'] <= 0:
-      availableNodes.items.pop(availableNodes.items.index(node))
-  
-  return sorted(availableNodes.items, key = lambda k: k.metadata.labels['score'], reverse=True)
+def volAffinityMask(expressions, podTopology):
+  if expressions is None:
+    return podTopology.allMask
+  mask = podTopology.allMask if expressions else 0
+  for key, operator, values in expressions:
+    inMask = 0
+    for value in values:
+      inMask |= podTopology.domainMask(key, value)
+    if operator == IN:
+      mask &= inMask
+    elif operator == NOTIN:
+      mask &= podTopology.keyMask(key) & ~inMask
+    elif operator == EXISTS:
+      mask &= podTopology.keyMask(key)
+    elif operator == DOESNOTEXIST:
+      mask &= ~podTopology.keyMask(key)
+  return mask
 
 # /
   # Description: Calculate the total resources needed for the pod
@@ -429,7 +345,7 @@ def getTotalResourcesRequested(containerArray):
       if 'cpu' in container.resources.requests:
         totalCpu += helpers.checkCpuString(container.resources.requests['cpu'])
       if 'memory' in container.resources.requests:
-        totalMemories += parse_quantity(container.resources.requests['memory'])
+        totalMemories += utils.parse_quantity(container.resources.requests['memory'])
   return totalCpu, totalMemories
 
 # /
@@ -460,7 +376,7 @@ def getPVs(apiClient, storageClassNames, podName):
 # /
 def getPVCs(apiClient, namespace, pvcTemplateName, podName):
   tempPvcs = apiClient.list_namespaced_persistent_volume_claim(namespace)
-  podPVCs = V1PersistentVolumeList(items = [])
+  podPVCs = client.V1PersistentVolumeList(items = [])
   for pvc in tempPvcs.items:
     if pvc.status.phase == PENDING or pvc.status.phase == BOUND:
       for pvcName in pvcTemplateName:
@@ -497,7 +413,8 @@ def bindPV(apiClient, bindings, namespace):
         apiClient.patch_persistent_volume(requiredBinding['pv'].metadata.name, requiredBinding['pv'])
         boundPVs.append({'pv': requiredBinding['pv'].metadata.name})
         #revertPVs(boundPVs)
-      except ApiException as e:
+        break
+      except client.rest.ApiException as e:
         if e.status == 409 and count < MAXCOUNT:
           count += 1
           logging.info("Conflict error, trying again")
@@ -525,7 +442,8 @@ def bindPVC(apiClient, bindings, namespace):
         logging.info("Binding the PVC %s to PV %s" % (requiredBinding['pvc'].metadata.name, requiredBinding['pv'].metadata.name))
         apiClient.patch_namespaced_persistent_volume_claim(requiredBinding['pvc'].metadata.name, namespace, requiredBinding['pvc'])
         boundPVCs.append({'pvc': requiredBinding['pvc'].metadata.name})
-      except ApiException as e:
+        break
+      except client.rest.ApiException as e:
         if e.status == 409 and count < MAXCOUNT:
           count += 1
           logging.info("Conflict error, trying again")
@@ -563,7 +481,7 @@ def checkPVAllocatability(pvs, podPVCs, podName):
     pvMap = {'pvc': pvc, 'pv': []}
     for pv in pvs:
       # check if this PV already has been not been claimed and the capacity is adquete
-      if pv.spec.claim_ref is None and parse_quantity(pv.spec.capacity['storage']) >= parse_quantity(pvc.spec.resources.requests['storage']):
+      if pv.spec.claim_ref is None and utils.parse_quantity(pv.spec.capacity['storage']) >= utils.parse_quantity(pvc.spec.resources.requests['storage']):
         pvMap['pv'].append(pv) #, pv.spec.capacity['storage']))
     sorted(pvMap['pv'], key = lambda k: k.spec.capacity['storage'], reverse=True)
     if len(pvMap['pv']) > 0:
@@ -574,106 +492,296 @@ def checkPVAllocatability(pvs, podPVCs, podName):
   return pvPVC
 
 # /
-  # Description: manages the storage for PVs and PVCs
+  # Description: loads the PVs and PVCs for the pod and determines which PVCs are bound and which PVs are
+  #   available for the unbound PVCs. Used as the storage loader of the SchedulingContext so the PV and PVC lists
+  #   are only retrieved if a decision reaches the storage filter.
   #
   # Inputs:
-  #   apiClient: Kubernetes client object
-  #   statefulSetPVCs: list of PVCS for the statefulSet
-  #   nodes: list of available nodes to check for storage compliance
-  #   pod: name of the pod of interest
-  #   namespace: Kubernetes namespace
-  #   
+  #   context: SchedulingContext of the decision
 # /
-def manageStorage(apiClient, statefulSetPVCs, nodes, pod, namespace):
-  storageOK = False
+def loadStorage(context):
   sc = []
   pvcTemplateNames = []
-  for pvc in statefulSetPVCs:
+  for pvc in context.ssPvcs:
     sc.append(pvc.spec.storage_class_name)
     pvcTemplateNames.append(pvc.metadata.name)
-    sc = helpers.unique(sc)
+  sc = helpers.unique(sc)
   pvcTemplateNames = helpers.unique(pvcTemplateNames)
-  #logging.debug("Required storageClasses: %s" % sc)
 
-  pvs = getPVs(apiClient = apiClient, storageClassNames = sc, podName = pod)
-  #logging.debug("All PVs: %s" % pvs)
+  pvs = getPVs(apiClient = context.apiClient, storageClassNames = sc, podName = context.pod)
+  pvcs = getPVCs(apiClient = context.apiClient, namespace = context.iCfg['namespace'], pvcTemplateName = pvcTemplateNames, podName = context.pod)
 
-  pvcs = getPVCs(apiClient = apiClient, namespace = namespace, pvcTemplateName = pvcTemplateNames, podName = pod)
-  #logging.debug("All PVCs: %s" % pvcs)
-
-  pvMap = checkPVAllocatability(pvs, pvcs, pod)
+  pvMap = checkPVAllocatability(pvs, pvcs, context.pod)
   for data in pvMap['allocatable']:
     logging.info("PVC: %s" % data['pvc'].metadata.name)
     for x in data['pv']:
       logging.info("Associated PVs: %s" % x.metadata.name)
-  #logging.debug("PV and PVC mapping: %s" % pvMap)
+
+  if context.ledger is not None:
+    with context.lock:
+      reservedPVs(pvMap, context.ledger, context.exclude)
 
   logging.debug("Allocated count: %s, unallocated count: %s, broken count: %s" % (len(pvMap['allocated']), len(pvMap['allocatable']), len(pvMap['unallocatable']) ))
+  return pvMap
 
-  if len(pvMap['unallocatable']) > 0:
-    for un in pvMap['unallocatable']:
-      logging.error("Cannot allocate PVC %s" % un['pvc'])
-  else:
-    # Check allocated possible for selected node
-    phaseOneNodes = copy.deepcopy(nodes)
-    for node in reversed(nodes):
-      passAllocated = False
-      passUnallocated = False
+# /
+  # Description: removes the PVs held by the reservations of other pods from a PV/PVC mapping and puts the PVs reserved
+  #   for the pod first, so the reserved PVs are the ones bound. PVCs left without a PV become unallocatable.
+  #
+  # Inputs:
+  #   pvMap: PV/PVC mapping from `checkPVAllocatability`
+  #   ledger: ResourceLedger holding the reservations
+  #   exclude: Names of the pods being placed
+# /
+def reservedPVs(pvMap, ledger, exclude):
+  held = ledger.heldPVs(exclude)
+  reserved = ledger.heldPVs() - held
+  for data in list(pvMap['allocatable']):
+    data['pv'] = sorted((pv for pv in data['pv'] if pv.metadata.name not in held), key = lambda pv: pv.metadata.name not in reserved)
+    if len(data['pv']) == 0:
+      logging.info("PVs for PVC %s are reserved for other pods" % data['pvc'].metadata.name)
+      pvMap['allocatable'].remove(data)
+      pvMap['unallocatable'].append({'pvc': data['pvc'].metadata.name})
+
+# /
+  # Description: Selects a distinct available PV for each unbound PVC that satisfies the PV node affinity for a node.
+  #   Returns the list of PVC/PV bindings, or None if a PVC has no PV for the node.
+  #
+  # Inputs:
+  #   allocatable: List of PVCs and their available PVs from `checkPVAllocatability`
+  #   node: Node to check against
+# /
+def assignPVs(allocatable, node):
+  assigned = []
+  used = set()
+  for pvPvcCombo in allocatable:
+    for pvAvail in pvPvcCombo['pv']:
+      if pvAvail.metadata.name not in used and checkNodeVolAffinity(pv = pvAvail, node = node):
+        logging.debug("PV %s ok for PVC %s and Node %s" % (pvAvail.metadata.name, pvPvcCombo['pvc'].metadata.name, node.metadata.name))
+        used.add(pvAvail.metadata.name)
+        assigned.append({"pvc": pvPvcCombo['pvc'], "pv": pvAvail})
+        break
+    else:
+      logging.debug("No PV for PVC %s on Node %s" % (pvPvcCombo['pvc'].metadata.name, node.metadata.name))
+      return None
+  return assigned
+
+# /
+  # Description: Binds the PVs selected for a node to the unbound PVCs of the pod.
+  #
+  # Inputs:
+  #   apiClient: The API gateway
+  #   pvMap: PV/PVC mapping from `checkPVAllocatability`
+  #   node: Node selected for the pod
+  #   pod: name of the pod of interest
+  #   namespace: Kubernetes namespace
+  #
+  # Returns the PVC/PV bindings made, or None if the PVs could not be bound.
+# /
+def bindStorage(apiClient, pvMap, node, pod, namespace):
+  pvToPVC = assignPVs(pvMap['allocatable'], node)
+  if pvToPVC is None:
+    logging.warn("No PVs available for pod %s on node %s" % (pod, node.metadata.name))
+    return None
+
+  for storage in pvToPVC:
+    logging.info("Pod: %s, PVC allocatable: %s, PVs: %s" % (pod, storage['pvc'].metadata.name, storage['pv'].metadata.name))
+  for storage in pvMap['allocated']:
+    logging.info("Pod: %s, PVC bound: %s" % (pod, storage['pvc'].metadata.name))
+  boundPVSuccess = bindPV(apiClient = apiClient, bindings = pvToPVC, namespace = namespace)
+  if boundPVSuccess is True and bindPVC(apiClient = apiClient, bindings = pvToPVC, namespace = namespace) is True:
+    return pvToPVC
+  return None
+
+# /
+  # Description: Filter plugin keeping the nodes in the data centre selected for the pod.
+# /
+class DataCentreFilter(object):
+  name = "dataCentre"
+
+  def filter(self, context, candidates):
+    return candidates & context.topology.domainMask(context.iCfg['dataCentresLabel'], context.dataCentre)
+
+# /
+  # Description: Filter plugin keeping the nodes that are Ready.
+# /
+class ReadyFilter(object):
+  name = "ready"
+
+  def filter(self, context, candidates):
+    return candidates & context.topology.readyMask
+
+# /
+  # Description: Filter plugin for the required pod affinity or antiaffinity of the pod. For each rule the domains
+  #   of the topology key holding a matching pod are looked up and their nodes kept (affinity) or removed
+  #   (antiaffinity). Nodes without the topology key never satisfy affinity and always satisfy antiaffinity.
+  #   As in Kubernetes, an affinity rule no pod matches is ignored if the pod matches the rule itself, so the first
+  #   pod of a group with affinity to itself can be placed.
+  #
+  # Inputs:
+  #   affinityType: AFFINITY or ANTIAFFINITY
+# /
+class PodAffinityFilter(object):
+
+  def __init__(self, affinityType):
+    self.affinityType = affinityType
+    self.name = "podAntiAffinity" if affinityType == ANTIAFFINITY else "podAffinity"
+
+  def filter(self, context, candidates):
+    affinityObject = context.podObject.spec.affinity
+    if affinityObject is None:
+      return candidates
+    if self.affinityType == ANTIAFFINITY:
+      podAffinity = affinityObject.pod_anti_affinity
+    else:
+      podAffinity = affinityObject.pod_affinity
+    if podAffinity is None:
+      return candidates
+    if podAffinity.preferred_during_scheduling_ignored_during_execution is not None:
+      logging.warn("Preferred %s is ignored" % self.name)
+      logging.debug("%s", podAffinity.preferred_during_scheduling_ignored_during_execution)
+    if podAffinity.required_during_scheduling_ignored_during_execution is None:
+      return candidates
+    for requiredRule in podAffinity.required_during_scheduling_ignored_during_execution:
+      # lazy formatting, the repr of the rule is expensive
+      logging.debug("REQUIRED %s RULE: %s", self.name, requiredRule)
+      if requiredRule.label_selector is None:
+        continue
+      occupied = 0
+      for domain, podCount in context.topology.domainCounts(requiredRule.topology_key, requiredRule.label_selector).items():
+        if podCount > 0:
+          logging.debug("Matching pods in %s %s: %s" % (requiredRule.topology_key, domain, podCount))
+          occupied |= context.topology.domainMask(requiredRule.topology_key, domain)
+      if self.affinityType == ANTIAFFINITY:
+        candidates &= ~occupied
+      elif occupied == 0 and topology.selectorMatches(topology.selectorKey(requiredRule.label_selector), context.podObject.metadata.labels or {}):
+        logging.debug("No pods match the %s rule of pod %s, which matches it itself" % (self.name, context.pod))
+      else:
+        candidates &= occupied
+      if not candidates:
+        break
+    return candidates
+
+# /
+  # Description: Filter plugin for the `topologySpreadConstraints` of the pod. The skew for each domain is calculated
+  #   from the count of matching pods in the domain against the least populated eligible domain for the key. As in
+  #   Kubernetes only the domains with a Ready node in the data centre selected for the pod are eligible.
+# /
+class TopologySpreadFilter(object):
+  name = "topologySpread"
+
+  def filter(self, context, candidates):
+    for constraint in context.podObject.spec.topology_spread_constraints or []:
+      if constraint.when_unsatisfiable != DONOTSCHEDULE:
+        logging.warn("Topology spread constraint %s for %s is ignored" % (constraint.topology_key, constraint.when_unsatisfiable))
+        continue
+      counts = context.topology.domainCounts(constraint.topology_key, constraint.label_selector)
+      eligible = context.topology.domainMask(context.iCfg['dataCentresLabel'], context.dataCentre) & context.topology.readyMask
+      domains = dict((domain, mask) for domain, mask in context.topology.domains[constraint.topology_key].items() if mask & eligible)
+      if not domains:
+        logging.warn("No Ready nodes with topology key %s in data centre %s" % (constraint.topology_key, context.dataCentre))
+        return 0
+      minCount = min(counts.get(domain, 0) for domain in domains)
+      allowed = 0
+      for domain, mask in domains.items():
+        if counts.get(domain, 0) + 1 - minCount <= constraint.max_skew:
+          allowed |= mask
+      candidates &= allowed
+      if not candidates:
+        break
+    return candidates
+
+# /
+  # Description: Filter plugin scoring the nodes for available resources, nodes the pod does not fit on are removed.
+  #   The resources committed on the node by other pods and reservations are taken into account when the context
+  #   has a ledger.
+# /
+class ResourceFilter(object):
+  name = "resources"
+
+  def filter(self, context, candidates):
+    for slot in pipeline.bits(candidates):
+      node = context.topology.nodeAt(slot)
+      committedCPU, committedMem = (0, 0)
+      if context.ledger is not None:
+        committedCPU, committedMem = context.ledger.committed(node.metadata.name, context.exclude)
+      score = nodeFreeScore(node, committedCPU, committedMem, context.requestedCPU, context.requestedMem)
+      if score is None:
+        candidates &= ~(1 << slot)
+      else:
+        context.scores[slot] = score
+    return candidates
+
+# /
+  # Description: Filter plugin keeping the nodes where the bound PVs of the pod can be used and a PV is available for
+  #   each unbound PVC.
+# /
+class StorageFilter(object):
+  name = "storage"
+
+  # the PVs and PVCs are loaded before the filter runs, without holding the lock
+  def prepare(self, context):
+    if context.ssPvcs:
+      context.storage()
+
+  def filter(self, context, candidates):
+    if not context.ssPvcs:
+      logging.info("No PVCs required")
+      return candidates
+    pvMap = context.storage()
+    if len(pvMap['unallocatable']) > 0:
+      for un in pvMap['unallocatable']:
+        logging.error("Cannot allocate PVC %s" % un['pvc'])
+      return 0
+    for slot in pipeline.bits(candidates):
+      node = context.topology.nodeAt(slot)
       for pvPvcCombo in pvMap['allocated']:
         logging.debug("Checking allocated PVCs/PV node affinity for node %s" % node.metadata.name)
-        passAllocated = checkNodeVolAffinity(pv = pvPvcCombo['pv'], node = node)
-        if passAllocated is False:
-          if node in nodes:
-            nodes.pop(nodes.index(node))
+        if checkNodeVolAffinity(pv = pvPvcCombo['pv'], node = node) is False:
+          candidates &= ~(1 << slot)
           break
-      if len(phaseOneNodes) < 1:
-        logging.warn("No nodes available for the bound PVC/PVs")
-        break
+      else:
+        if assignPVs(pvMap['allocatable'], node) is None:
+          candidates &= ~(1 << slot)
+    return candidates
 
-    nodes = copy.deepcopy(phaseOneNodes)
-    for node in reversed(nodes):
-      # need a deepcopy here to reset
-      tempPvMap = copy.deepcopy(pvMap['allocatable'])
-      # set the allocation to be false by default
-      pvAllocSuccess = False
-      for pvPvcCombo in tempPvMap:
-        for pvAvail in reversed(pvPvcCombo['pv']):
-          logging.debug("Checking unallocated PVCs/PV node affinity for node %s with PV %s" % (node.metadata.name, pvAvail.metadata.name))
-          passUnallocated = checkNodeVolAffinity(pv = pvAvail, node = node)
-          if passUnallocated is True:
-            logging.debug("PV %s ok for PVC %s and Node %s" %(pvAvail.metadata.name, pvPvcCombo['pvc'].metadata.name ,node.metadata.name))
-            pvAllocSuccess = True
-            break
-          else:
-            logging.debug("Removing PV %s from list for PVC %s and Node %s" %(pvAvail.metadata.name, pvPvcCombo['pvc'].metadata.name ,node.metadata.name))
-            pvAvail.pop(pvAvail.index(pvAvail))
-        if pvAllocSuccess is True:
-          logging.debug("Success for PV/PVC on node")
-          break
-        else:
-          nodes.pop(nodes.index(node))
-      # check if the PVC allocation test was correct
-      #if pvAllocSuccess is True:
-      #  pvMap['allocatable'] 
-          
-    if len(nodes) < 0:
-      logging.warn("No node available")
-      return False
-    else:
-      # clean up and make PV allocation unique
-      pvToPVC = helpers.cleanMultiples(pvpvcList = pvMap['allocatable'])
-      
-      # Bind PVC and PV
-      for storage in pvToPVC:
-        logging.info("Pod: %s, PVC allocatable: %s, PVs: %s" % (pod, storage['pvc'].metadata.name, storage['pv'].metadata.name))
-      for storage in pvMap['allocated']:
-        logging.info("Pod: %s, PVC bound: %s" % (pod, storage['pvc'].metadata.name))
-      boundPVSuccess = bindPV(apiClient = apiClient, bindings = pvToPVC, namespace = namespace)
-      if boundPVSuccess is True:
-        boundPVCSuccess = bindPVC(apiClient = apiClient, bindings = pvToPVC, namespace = namespace)
-        if boundPVCSuccess is True:
-          storageOK = True
-  return storageOK
+# /
+  # Description: Score plugin ordering the nodes by their resource score, best first.
+# /
+class ResourceScore(object):
+  name = "score"
+
+  def score(self, context, candidates):
+    return sorted(pipeline.bits(candidates), key = lambda slot: context.scores[slot], reverse = True)
+
+# The filters run cheapest and most selective first, storage last as it needs the PV and PVC lists
+PIPELINE = pipeline.Pipeline([
+  DataCentreFilter(),
+  ReadyFilter(),
+  PodAffinityFilter(ANTIAFFINITY),
+  PodAffinityFilter(AFFINITY),
+  TopologySpreadFilter(),
+  ResourceFilter(),
+  StorageFilter()
+], ResourceScore())
+
+# The filters for a member being recreated with its PVs bound, the bound PVs have already selected the nodes
+BOUNDPIPELINE = pipeline.Pipeline([
+  ReadyFilter(),
+  PodAffinityFilter(ANTIAFFINITY),
+  ResourceFilter()
+], ResourceScore())
+
+# The filters for the non-electable member on its reserved node, the node was selected when it was reserved
+RESERVEDPIPELINE = pipeline.Pipeline([
+  DataCentreFilter(),
+  ReadyFilter(),
+  PodAffinityFilter(ANTIAFFINITY),
+  ResourceFilter()
+], ResourceScore())
+
+# The same when planning, when the reserved PVs are checked by the storage filter
+RESERVEDPLANPIPELINE = pipeline.Pipeline(RESERVEDPIPELINE.filters + [StorageFilter()], ResourceScore())
 
 # /
   # Description: function to schedule the statefulSet.
@@ -701,98 +809,1042 @@ def scheduler(apiClient, bindingName, targetName, namespace):
   
   return apiClient.create_namespaced_binding(namespace, body, _preload_content=False)
 
+# /
+  # Description: function to determine if a pod from the watch stream is for this scheduler to place.
+  #
+  # Inputs:
+  #   podObject: Pod object from the watch stream
+  #   schedulerName: The name of this scheduler
+# /
+def toSchedule(podObject, schedulerName):
+  return podObject.status.phase == "Pending" and podObject.spec.scheduler_name == schedulerName and podObject.status.conditions is None
+
+# /
+  # Description: function to find the bound PVs of a member being recreated with all of its PVCs already bound, and
+  #   refresh the nodes the PVs allow. Only GETs are made: each PVC and its PV, and the nodes the PVs allow.
+  #   Returns the compiled node affinity of each PV and the PVC/PV names, or None if a PVC is not bound or the PVs do
+  #   not keep the pod in a single data centre, in which case the pod goes through the full scheduling path.
+  #
+  # Inputs:
+  #   podObject: Pod object from the watch stream
+  #   apiClient: The API gateway
+  #   iCfg: The scheduler configuration
+  #   podTopology: TopologyIndex of the nodes and pods
+  #   lock: Lock held while the topology index is read or changed
+# /
+def boundStorageCandidates(podObject, apiClient, iCfg, podTopology, lock):
+  pod = podObject.metadata.name
+  claims = [volume.persistent_volume_claim.claim_name for volume in podObject.spec.volumes or [] if volume.persistent_volume_claim is not None]
+  if len(claims) == 0:
+    return None
+  affinities = []
+  pvs = []
+  for claim in claims:
+    try:
+      pvc = apiClient.read_namespaced_persistent_volume_claim(claim, iCfg['namespace'])
+    except client.rest.ApiException as e:
+      if e.status == 404:
+        logging.debug("PVC %s for pod %s does not exist yet" % (claim, pod))
+        return None
+      raise
+    if pvc.status.phase != BOUND or pvc.spec.volume_name is None:
+      logging.debug("PVC %s for pod %s is not bound" % (claim, pod))
+      return None
+    pv = apiClient.read_persistent_volume(pvc.spec.volume_name)
+    affinities.append(compileVolAffinity(pv))
+    pvs.append({"pvc": claim, "pv": pv.metadata.name})
+
+  with lock:
+    dataCentre, candidates = boundDataCentre(pod, affinities, iCfg, podTopology)
+    nodeNames = [podTopology.nodeArray[slot] for slot in pipeline.bits(candidates)]
+  if dataCentre is None:
+    return None
+  # refresh the candidate nodes, the labels of the nodes may have changed so the nodes are checked again
+  if len(nodeNames) > MAXBOUNDNODES:
+    refreshNodes(apiClient = apiClient, topology = podTopology, lock = lock)
+  else:
+    for nodeName in nodeNames:
+      try:
+        node = apiClient.read_node(nodeName)
+      except client.rest.ApiException as e:
+        if e.status != 404:
+          raise
+        node = None
+      with lock:
+        if node is None:
+          podTopology.removeNode(nodeName)
+        else:
+          podTopology.refreshNode(node)
+  return affinities, pvs
+
+# /
+  # Description: function to determine the nodes allowed by the bound PVs of a pod and the data centre they are in.
+  #   Returns the data centre and the bitset of the nodes, or None and the bitset if the nodes are not all in one data
+  #   centre.
+  #
+  # Inputs:
+  #   pod: Name of the pod
+  #   affinities: Compiled node affinity of each bound PV
+  #   iCfg: The scheduler configuration
+  #   podTopology: TopologyIndex of the nodes and pods
+# /
+def boundDataCentre(pod, affinities, iCfg, podTopology):
+  candidates = podTopology.allMask
+  for expressions in affinities:
+    candidates &= volAffinityMask(expressions, podTopology)
+  dataCentres = set(podTopology.domainOf(podTopology.nodeArray[slot], iCfg['dataCentresLabel']) for slot in pipeline.bits(candidates))
+  if len(dataCentres) != 1 or None in dataCentres:
+    logging.debug("Bound PVs of pod %s allow data centres %s" % (pod, sorted(str(dc) for dc in dataCentres)))
+    return None, candidates
+  return dataCentres.pop(), candidates
+
+# /
+  # Description: function to reserve a node, resources and PVs for the non-electable member of a statefulSet before it
+  #   is created, so other members cannot take them. The data centre and node are selected as if the member was being
+  #   scheduled, or the node it is running on is reserved if it is running. Returns the new reservation or None.
+  #
+  # Inputs:
+  #   podObject: Pod object of another member of the statefulSet
+  #   apiClient: The API gateway
+  #   iCfg: The scheduler configuration
+  #   podTopology: TopologyIndex of the nodes and pods
+  #   ledger: ResourceLedger holding the reservations
+  #   ss: Name of the statefulSet
+  #   replicas: The number of replicas in the statefulSet
+  #   ssPvcs: PVC templates of the statefulSet
+  #   lock: Lock held while the topology index and ledger are read or changed
+# /
+def reserveNonElectable(podObject, apiClient, iCfg, podTopology, ledger, ss, replicas, ssPvcs, lock):
+  pod = "%s-%d" % (ss, int(replicas) - 1)
+  member = copy.copy(podObject)
+  member.metadata = copy.copy(podObject.metadata)
+  member.metadata.name = pod
+  exclude = (pod,)
+  requestedCPU, requestedMem = getTotalResourcesRequested(member.spec.containers)
+  with lock:
+    if ledger.reservation(ss) is not None:
+      return None
+    if pod in ledger.pods and podTopology.domainOf(ledger.pods[pod][0], iCfg['dataCentresLabel']) in iCfg['noPrimaryDataCentres']:
+      # running, e.g. when the scheduler restarted, its PVs are bound so only the node and resources are held
+      nodeName, cpu, mem = ledger.pods[pod]
+      return ledger.reserve(ss, pod, podTopology.domainOf(nodeName, iCfg['dataCentresLabel']), nodeName, [], cpu, mem)
+    dataCentre = findDC(podName = pod, replicas = replicas, primaryDataCentres = iCfg['primaryDataCentres'], noPrimaryDataCentres = iCfg['noPrimaryDataCentres'], freeCapacity = lambda dc: dataCentreCapacity(dc, podTopology, ledger, iCfg, requestedCPU, requestedMem, exclude))
+
+  def storageLoader(context):
+    pvs = dict((pv.metadata.name, pv) for pv in apiClient.list_persistent_volume().items)
+    pvcs = dict((pvc.metadata.name, pvc) for pvc in apiClient.list_namespaced_persistent_volume_claim(iCfg['namespace']).items)
+    with lock:
+      held = ledger.heldPVs(exclude)
+    return planStorage(pvs, pvcs, ssPvcs, pod, held)
+
+  context = pipeline.SchedulingContext(member, dataCentre, requestedCPU, requestedMem, ssPvcs, iCfg, podTopology, apiClient, storageLoader, ledger = ledger, exclude = exclude, lock = lock)
+  nodes = PIPELINE.run(context)
+  if not nodes:
+    logging.warn("No node to reserve for pod %s in data centre %s, rejected by %s" % (pod, dataCentre, context.rejectedBy))
+    return None
+  with lock:
+    node = podTopology.nodeObjects.get(nodes[0])
+    if node is None:
+      return None
+    pvs = []
+    if ssPvcs:
+      # the node can have changed since the pipeline ran
+      assigned = assignPVs(context.storage()['allocatable'], node)
+      if assigned is None:
+        logging.warn("No PVs to reserve for pod %s on node %s" % (pod, nodes[0]))
+        return None
+      pvs = [storage['pv'].metadata.name for storage in context.storage()['allocated'] + assigned]
+    return ledger.reserve(ss, pod, dataCentre, nodes[0], pvs, requestedCPU, requestedMem)
+
+# /
+  # Description: function to determine the PV/PVC mapping of the non-electable member on its reserved node from its
+  #   PVCs and the reserved PVs. Only GETs are made: each PVC of the pod, the PVs they are bound to and the reserved
+  #   PVs. Returns the mapping, or None if a PVC does not exist yet, a bound PV is not available on the node or there is
+  #   no reserved PV for an unbound PVC.
+  #
+  # Inputs:
+  #   podObject: Pod object from the watch stream
+  #   apiClient: The API gateway
+  #   iCfg: The scheduler configuration
+  #   reserved: Reservation of the pod
+  #   node: V1Node object of the reserved node
+# /
+def reservedStorage(podObject, apiClient, iCfg, reserved, node):
+  pod = podObject.metadata.name
+  pvMap = {
+    "allocatable": [],
+    "unallocatable": [],
+    "allocated": []
+  }
+  unbound = []
+  for volume in podObject.spec.volumes or []:
+    if volume.persistent_volume_claim is None:
+      continue
+    try:
+      pvc = apiClient.read_namespaced_persistent_volume_claim(volume.persistent_volume_claim.claim_name, iCfg['namespace'])
+    except client.rest.ApiException as e:
+      if e.status == 404:
+        logging.info("PVC %s for pod %s does not exist yet" % (volume.persistent_volume_claim.claim_name, pod))
+        return None
+      raise
+    if pvc.status.phase != BOUND or pvc.spec.volume_name is None:
+      unbound.append(pvc)
+      continue
+    pv = apiClient.read_persistent_volume(pvc.spec.volume_name)
+    if checkNodeVolAffinity(pv = pv, node = node) is False:
+      logging.info("PV %s of pod %s is not available on reserved node %s" % (pv.metadata.name, pod, node.metadata.name))
+      return None
+    pvMap['allocated'].append({'pvc': pvc, 'pv': pv})
+  if len(unbound) == 0:
+    return pvMap
+
+  pvs = []
+  boundPVs = set(storage['pv'].metadata.name for storage in pvMap['allocated'])
+  for name in reserved['pvs']:
+    if name in boundPVs:
+      continue
+    try:
+      pv = apiClient.read_persistent_volume(name)
+    except client.rest.ApiException as e:
+      if e.status == 404:
+        continue
+      raise
+    if pv.spec.claim_ref is None and pv.status.phase == AVAILABLE:
+      pvs.append(pv)
+  for pvc in unbound:
+    requested = utils.parse_quantity(pvc.spec.resources.requests['storage'])
+    pvMap['allocatable'].append({'pvc': pvc, 'pv': [pv for pv in pvs if pv.spec.storage_class_name == pvc.spec.storage_class_name and utils.parse_quantity(pv.spec.capacity['storage']) >= requested]})
+  if assignPVs(pvMap['allocatable'], node) is None:
+    logging.info("Reserved PVs %s do not fit the PVCs of pod %s" % (reserved['pvs'], pod))
+    return None
+  return pvMap
+
+# /
+  # Description: function to place the non-electable member on its reserved node. Only the reserved node, the PVCs of
+  #   the pod and the reserved PVs are read, so the placement does not depend on the size of the cluster. The
+  #   reservation is released if the node or the PVs can no longer take the pod. Returns the name of the node the pod
+  #   was bound to, or None if the pod has no reservation or it was released.
+  #
+  # Inputs:
+  #   podObject: Pod object from the watch stream
+  #   apiClient: The API gateway
+  #   iCfg: The scheduler configuration
+  #   podTopology: TopologyIndex of the nodes and pods
+  #   ledger: ResourceLedger holding the reservations
+  #   decision: Dictionary the decision is recorded in
+  #   lock: Lock held while the topology index and ledger are read or changed
+  #   requestedCPU: CPU requested by the pod
+  #   requestedMem: Memory requested by the pod
+# /
+def placeReserved(podObject, apiClient, iCfg, podTopology, ledger, decision, lock, requestedCPU, requestedMem):
+  pod = podObject.metadata.name
+  ss = podObject.metadata.owner_references[0].name
+  with lock:
+    reserved = ledger.reservation(ss)
+    if reserved is None or reserved['pod'] != pod:
+      return None
+    if reserved['dataCentre'] not in iCfg['noPrimaryDataCentres']:
+      logging.warn("Data centre %s of the reservation of pod %s is no longer a non-electable data centre" % (reserved['dataCentre'], pod))
+      ledger.release(ss)
+      return None
+    reserved = dict(reserved)
+  decision['reserved'] = reserved['node']
+  decision['dataCentre'] = reserved['dataCentre']
+
+  phaseStart = time.perf_counter()
+  try:
+    node = apiClient.read_node(reserved['node'])
+  except client.rest.ApiException as e:
+    if e.status != 404:
+      raise
+    node = None
+  decision['phases']['reservedNode'] = time.perf_counter() - phaseStart
+  with lock:
+    if node is None:
+      podTopology.removeNode(reserved['node'])
+    else:
+      podTopology.refreshNode(node)
+    candidates = (1 << podTopology.slots[reserved['node']]) if reserved['node'] in podTopology.slots else 0
+    context = pipeline.SchedulingContext(podObject, reserved['dataCentre'], requestedCPU, requestedMem, None, iCfg, podTopology, apiClient, loadStorage, ledger = ledger, lock = lock)
+    nodes = RESERVEDPIPELINE.run(context, candidates)
+    decision['candidates'] = context.counts
+    decision['rejectedBy'] = context.rejectedBy
+    decision['scores'] = debug.topScores(nodes, context)
+  decision['phases'].update(context.timings)
+
+  pvMap = None
+  if nodes:
+    phaseStart = time.perf_counter()
+    pvMap = reservedStorage(podObject, apiClient, iCfg, reserved, node)
+    decision['phases']['reservedStorage'] = time.perf_counter() - phaseStart
+    if pvMap is None:
+      decision['rejectedBy'] = "storage"
+  if pvMap is None:
+    logging.warn("Reserved node %s can no longer take pod %s, rejected by %s" % (reserved['node'], pod, decision['rejectedBy']))
+    with lock:
+      ledger.release(ss)
+    decision['reserved'] = None
+    decision['dataCentre'] = None
+    return None
+
+  logging.info("Selected reserved node: %s" % reserved['node'])
+  pvToPVC = []
+  if pvMap['allocatable']:
+    phaseStart = time.perf_counter()
+    pvToPVC = bindStorage(apiClient = apiClient, pvMap = pvMap, node = node, pod = pod, namespace = iCfg['namespace'])
+    decision['phases']['bindStorage'] = time.perf_counter() - phaseStart
+    if pvToPVC is None:
+      decision['error'] = "Storage could not be bound"
+      return None
+  decision['pvs'] = [{"pvc": storage['pvc'].metadata.name, "pv": storage['pv'].metadata.name} for storage in pvMap['allocated'] + pvToPVC]
+  return bindPod(podObject, reserved['node'], apiClient, iCfg, podTopology, ledger, decision, lock, requestedCPU, requestedMem)
+
+# /
+  # Description: function to bind a pod to a node and record it in the topology index and ledger before the watch
+  #   reports it. Returns the name of the node.
+  #
+  # Inputs:
+  #   podObject: Pod object from the watch stream
+  #   nodeName: Name of the node
+  #   apiClient: The API gateway
+  #   iCfg: The scheduler configuration
+  #   podTopology: TopologyIndex of the nodes and pods
+  #   ledger: ResourceLedger, or None
+  #   decision: Dictionary the decision is recorded in
+  #   lock: Lock held while the topology index and ledger are changed
+  #   requestedCPU: CPU requested by the pod
+  #   requestedMem: Memory requested by the pod
+# /
+def bindPod(podObject, nodeName, apiClient, iCfg, podTopology, ledger, decision, lock, requestedCPU, requestedMem):
+  pod = podObject.metadata.name
+  phaseStart = time.perf_counter()
+  res = scheduler(apiClient = apiClient, bindingName = pod, targetName = nodeName, namespace = iCfg['namespace'])
+  decision['phases']['bind'] = time.perf_counter() - phaseStart
+  logging.debug("Bind result: %s" % res)
+  logging.info("Pod %s is bound to node %s" % (pod, nodeName))
+  decision['node'] = nodeName
+  with lock:
+    podTopology.assumePod(pod, nodeName, podObject.metadata.labels or {})
+    if ledger is not None:
+      ledger.usePod(pod, nodeName, requestedCPU, requestedMem)
+  return nodeName
+
+# /
+  # Description: function to place a pod: selects the data centre, filters and scores the nodes, manages the
+  #   storage and binds the pod. A member recreated with all of its PVCs bound is only checked against the nodes its
+  #   PVs allow, and the non-electable member is placed on its reserved node if it has a reservation that still fits.
+  #   The lock is only held while the topology index and ledger are read or changed, not while the API server is
+  #   called. Returns the name of the node the pod was bound to, or None.
+  #
+  # Inputs:
+  #   podObject: Pod object from the watch stream
+  #   apiClient: The API gateway
+  #   iCfg: The scheduler configuration
+  #   podTopology: TopologyIndex of the nodes and pods
+  #   flightRecorder: FlightRecorder to record the decision to, or None
+  #   ledger: ResourceLedger of the resources committed on each node and the reservations, or None to only use the
+  #     node capacity and not reserve
+  #   lock: Lock shared with the other users of the topology index and ledger, e.g. the ClusterCache lock, or None if
+  #     nothing else uses them
+# /
+def schedulePod(podObject, apiClient, iCfg, podTopology, flightRecorder = None, ledger = None, lock = None):
+  # record pod name
+  pod = podObject.metadata.name
+  logging.debug("Pod: %s" % pod)
+  if lock is None:
+    lock = threading.RLock()
+  # the configuration can be reloaded while the decision is made, the decision uses the configuration it started with
+  with lock:
+    iCfg = dict(iCfg)
+
+  # what is known about the decision, kept by the flight recorder
+  start = time.perf_counter()
+  apiBefore = flightRecorder.begin() if flightRecorder is not None else None
+  decision = {"pod": pod, "time": time.time(), "dataCentre": None, "node": None, "candidates": [], "rejectedBy": None, "scores": [], "pvs": [], "reserved": None, "fastPath": False, "phases": {}, "error": None}
+  try:
+    selectedNode = placePod(podObject, apiClient, iCfg, podTopology, ledger, decision, lock)
+    if selectedNode is None:
+      logging.error("Cannot schedule")
+    return selectedNode
+  except client.rest.ApiException as e:
+    # an API error, timeout or connection error only fails this decision
+    decision['error'] = e.reason
+    logging.error("Cannot schedule pod %s: %s" % (pod, helpers.apiErrorMessage(e)))
+  finally:
+    if flightRecorder is not None:
+      decision['totalMs'] = round((time.perf_counter() - start) * 1000, 3)
+      for phase, seconds in decision['phases'].items():
+        decision['phases'][phase] = round(seconds * 1000, 3)
+      flightRecorder.record(decision, apiBefore)
+  return None
+
+# /
+  # Description: function to make the scheduling decision for a pod and bind it, see schedulePod. Returns the name
+  #   of the node the pod was bound to, or None. API errors are raised.
+  #
+  # Inputs:
+  #   podObject: Pod object from the watch stream
+  #   apiClient: The API gateway
+  #   iCfg: The scheduler configuration
+  #   podTopology: TopologyIndex of the nodes and pods
+  #   ledger: ResourceLedger, or None
+  #   decision: Dictionary the decision is recorded in
+  #   lock: Lock held while the topology index and ledger are read or changed
+# /
+def placePod(podObject, apiClient, iCfg, podTopology, ledger, decision, lock):
+  pod = podObject.metadata.name
+
+  # records the statfulSet name
+  ss = podObject.metadata.owner_references[0].name
+  logging.debug("StatefulSet: %s, Pod: %s" % (ss, pod))
+
+  # pod affinity items for pod
+  podAffinity = podObject.spec.affinity
+  logging.debug("Affinity: %s" % podAffinity)
+
+  requestedCPU, requestedMem = getTotalResourcesRequested(podObject.spec.containers)
+  logging.debug("Requests: cpu: %s, mem: %s" % (requestedCPU, requestedMem))
+
+  # the non-electable member goes to its reserved node if it still fits, without listing anything
+  if ledger is not None:
+    selectedNode = placeReserved(podObject, apiClient, iCfg, podTopology, ledger, decision, lock, requestedCPU, requestedMem)
+    if selectedNode is not None or decision['error'] is not None:
+      return selectedNode
+
+  # a member recreated with all of its PVCs bound can only go where its PVs are, so only those nodes are checked
+  replicas = None
+  ssPvcs = None
+  sortedScoredNodes = []
+  phaseStart = time.perf_counter()
+  try:
+    bound = boundStorageCandidates(podObject, apiClient, iCfg, podTopology, lock)
+  except client.rest.ApiException as e:
+    logging.warn("Cannot check the bound PVs of pod %s: %s" % (pod, e.reason))
+    bound = None
+  decision['phases']['boundStorage'] = time.perf_counter() - phaseStart
+  if bound is not None:
+    affinities, pvs = bound
+    # the candidates are found and filtered holding the lock, as the slot of a removed node can be reused
+    with lock:
+      dataCentreSelected, candidates = boundDataCentre(pod, affinities, iCfg, podTopology)
+      if dataCentreSelected is not None:
+        decision['dataCentre'] = dataCentreSelected
+        decision['pvs'] = pvs
+        decision['fastPath'] = True
+        logging.debug("PVs of pod %s are bound, candidate nodes: %s" % (pod, pipeline.count(candidates)))
+        context = pipeline.SchedulingContext(podObject, dataCentreSelected, requestedCPU, requestedMem, None, iCfg, podTopology, apiClient, loadStorage, ledger = ledger, lock = lock)
+        sortedScoredNodes = BOUNDPIPELINE.run(context, candidates)
+        if len(sortedScoredNodes) == 0:
+          logging.info("Nodes of the bound PVs of pod %s rejected by %s, using the full scheduling path" % (pod, context.rejectedBy))
+          decision['fastPath'] = False
+          decision['pvs'] = []
+
+  if len(sortedScoredNodes) == 0:
+    # determine how many replicas and PVCs in the statefulSet
+    phaseStart = time.perf_counter()
+    replicas, ssPvcs = statefulSetCheck(apiClient = apiClient, stateful_set = ss, namespace = iCfg['namespace'])
+    decision['phases']['statefulSet'] = time.perf_counter() - phaseStart
+    logging.debug("Number of replicas in statefulSet: %s" % replicas)
+    logging.debug("PVCs in statefulSet: %s" % ssPvcs)
+
+    # Refresh the node array with the current nodes
+    phaseStart = time.perf_counter()
+    refreshNodes(apiClient = apiClient, topology = podTopology, lock = lock)
+    decision['phases']['nodes'] = time.perf_counter() - phaseStart
+
+    # determine which data centre to assign to the pod to
+    freeCapacity = None
+    if ledger is not None:
+      freeCapacity = lambda dc: dataCentreCapacity(dc, podTopology, ledger, iCfg, requestedCPU, requestedMem, (pod,))
+    with lock:
+      dataCentreSelected = findDC(podName = pod, replicas = replicas, primaryDataCentres = iCfg['primaryDataCentres'], noPrimaryDataCentres = iCfg['noPrimaryDataCentres'], freeCapacity = freeCapacity)
+    decision['dataCentre'] = dataCentreSelected
+    logging.debug("Selected data centre: %s" % dataCentreSelected)
+
+    # Filter and score the nodes
+    context = pipeline.SchedulingContext(podObject, dataCentreSelected, requestedCPU, requestedMem, ssPvcs, iCfg, podTopology, apiClient, loadStorage, ledger = ledger, lock = lock)
+    sortedScoredNodes = PIPELINE.run(context)
+  decision['phases'].update(context.timings)
+  decision['candidates'] = context.counts
+  decision['rejectedBy'] = context.rejectedBy
+  with lock:
+    decision['scores'] = debug.topScores(sortedScoredNodes, context)
+  logging.debug("Scored available nodes: %s" % sortedScoredNodes)
+  logging.debug("Filter timings: %s" % context.timings)
+
+  if len(sortedScoredNodes) == 0:
+    return None
+  selectedNode = sortedScoredNodes[0]
+  logging.info("Selected node: %s" % selectedNode)
+  with lock:
+    node = podTopology.nodeObjects.get(selectedNode)
+  if node is None:
+    logging.warn("Node %s was removed while pod %s was being placed" % (selectedNode, pod))
+    decision['error'] = "Node %s was removed" % selectedNode
+    return None
+  # the storage and the pod are bound without holding the lock, the binding can wait for the rate limit or retry
+  if ssPvcs:
+    phaseStart = time.perf_counter()
+    pvToPVC = bindStorage(apiClient = apiClient, pvMap = context.storage(), node = node, pod = pod, namespace = iCfg['namespace'])
+    decision['phases']['bindStorage'] = time.perf_counter() - phaseStart
+    if pvToPVC is None:
+      decision['error'] = "Storage could not be bound"
+      return None
+    decision['pvs'] = [{"pvc": storage['pvc'].metadata.name, "pv": storage['pv'].metadata.name} for storage in pvToPVC]
+  bindPod(podObject, selectedNode, apiClient, iCfg, podTopology, ledger, decision, lock, requestedCPU, requestedMem)
+  # the reservations are kept by the full path, a recreated member keeps the one it has
+  if ledger is not None and ledger.ttl > 0 and replicas is not None:
+    if int(pod.split('-')[-1]) == int(replicas) - 1:
+      pvs = [storage['pv'] for storage in decision['pvs']]
+      if ssPvcs:
+        pvs += [storage['pv'].metadata.name for storage in context.storage()['allocated']]
+      with lock:
+        ledger.reserve(ss, pod, dataCentreSelected, selectedNode, pvs, requestedCPU, requestedMem)
+    else:
+      # the pod is bound, failing to reserve for the non-electable member does not fail the decision
+      try:
+        reserveNonElectable(podObject, apiClient, iCfg, podTopology, ledger, ss, replicas, ssPvcs, lock)
+      except client.rest.ApiException as e:
+        logging.warn("Cannot reserve a node for the non-electable member of %s: %s" % (ss, helpers.apiErrorMessage(e)))
+  return selectedNode
+
+# /
+  # Description: function to determine the topology keys to index from the scheduler configuration.
+  #
+  # Inputs:
+  #   iCfg: The scheduler configuration
+# /
+def getTopologyKeys(iCfg):
+  topologyKeys = iCfg.get('topologyKeys', [HOSTNAME, ZONE])
+  return helpers.unique(topologyKeys + [iCfg['dataCentresLabel']])
+
+# /
+  # Description: function to create the topology index for the configured topology keys.
+  #
+  # Inputs:
+  #   iCfg: The scheduler configuration
+# /
+def newTopology(iCfg):
+  return topology.TopologyIndex(getTopologyKeys(iCfg))
+
+# /
+  # Description: function to determine the logging level from the scheduler configuration.
+  #
+  # Inputs:
+  #   iCfg: The scheduler configuration
+# /
+def getLogLevel(iCfg):
+  if iCfg['logLevel'].upper() == 'DEBUG':
+    return logging.DEBUG
+  return logging.INFO
+
+# /
+  # Description: function to configure logging from the scheduler configuration.
+  #
+  # Inputs:
+  #   iCfg: The scheduler configuration
+# /
+def configureLogging(iCfg):
+  logging.basicConfig(format='{"ts": "%(asctime)s, "f": "%(funcName)s", "l": %(lineno)d, "msg": "%(message)s"}', level=getLogLevel(iCfg))
+
+# /
+  # Description: function to validate the scheduler configuration, raises a ValueError describing the first problem found.
+  #
+  # Inputs:
+  #   iCfg: The scheduler configuration
+# /
+def validateConfig(iCfg):
+  if not isinstance(iCfg, dict):
+    raise ValueError("Configuration must be a mapping")
+  for key in ['namespace', 'logLevel', 'dataCentresLabel']:
+    if not isinstance(iCfg.get(key), str) or not iCfg[key]:
+      raise ValueError("`%s` must be a non-empty string" % key)
+  for key in ['primaryDataCentres', 'noPrimaryDataCentres']:
+    if not isinstance(iCfg.get(key), list) or not iCfg[key] or not all(isinstance(dc, str) for dc in iCfg[key]):
+      raise ValueError("`%s` must be a non-empty array of data centre names" % key)
+  if 'topologyKeys' in iCfg and (not isinstance(iCfg['topologyKeys'], list) or not all(isinstance(key, str) for key in iCfg['topologyKeys'])):
+    raise ValueError("`topologyKeys` must be an array of node labels")
+  if 'reservationTTL' in iCfg and (isinstance(iCfg['reservationTTL'], bool) or not isinstance(iCfg['reservationTTL'], (int, float)) or iCfg['reservationTTL'] < 0):
+    raise ValueError("`reservationTTL` must be a number of seconds, 0 or more")
+
+# /
+  # Description: function to apply a changed configuration to the running scheduler. The new configuration is validated
+  #   and then swapped in while holding the cluster cache lock, so a decision or plan never sees half of it. Only the
+  #   topology keys that are added or no longer used are indexed or dropped. Settings that are only read at start up keep
+  #   their current value until the scheduler is restarted.
+  #
+  # Inputs:
+  #   iCfg: The running scheduler configuration, updated in place
+  #   newCfg: The new scheduler configuration
+  #   clusterCache: ClusterCache holding the topology index
+  #   ledger: ResourceLedger holding the reservations, or None
+  #   capture: Recorder the scheduler events are recorded with, or None
+# /
+def reloadConfig(iCfg, newCfg, clusterCache, ledger = None, capture = None):
+  validateConfig(newCfg)
+  for key in RESTARTKEYS:
+    if newCfg.get(key) != iCfg.get(key):
+      logging.warn("Changing `%s` requires a restart, keeping %s" % (key, iCfg.get(key)))
+      if key in iCfg:
+        newCfg[key] = iCfg[key]
+      else:
+        newCfg.pop(key, None)
+  changed = sorted(key for key in set(iCfg) | set(newCfg) if iCfg.get(key) != newCfg.get(key))
+  if not changed:
+    logging.info("No configuration changes to apply")
+    return
+  with clusterCache.lock:
+    applyConfig(iCfg, newCfg, clusterCache.topology, ledger)
+    if capture is not None:
+      capture.config(iCfg)
+  logging.info("Configuration changes applied: %s" % ", ".join(changed))
+  logging.debug("Config: %s" % iCfg)
+
+# /
+  # Description: function to swap in a validated configuration: the topology keys that are added or no longer used are
+  #   indexed or dropped and the reservations it no longer allows are released. The caller holds the cluster cache lock.
+  #
+  # Inputs:
+  #   iCfg: The running scheduler configuration, updated in place
+  #   newCfg: The new scheduler configuration
+  #   podTopology: TopologyIndex of the pods
+  #   ledger: ResourceLedger holding the reservations, or None
+# /
+def applyConfig(iCfg, newCfg, podTopology, ledger = None):
+  oldKeys = getTopologyKeys(iCfg)
+  newKeys = getTopologyKeys(newCfg)
+  for key in newKeys:
+    podTopology.addKey(key)
+  for key in oldKeys:
+    if key not in newKeys:
+      podTopology.removeKey(key)
+  if ledger is not None:
+    releaseReservations(ledger, iCfg, newCfg)
+  iCfg.clear()
+  iCfg.update(newCfg)
+  logging.getLogger().setLevel(getLogLevel(iCfg))
+
+# /
+  # Description: function to release the reservations the new configuration no longer allows: those in a data centre
+  #   that is no longer a non-electable data centre, or every reservation if the data centre label changed. They are
+  #   made again as the statefulSets are scheduled.
+  #
+  # Inputs:
+  #   ledger: ResourceLedger holding the reservations
+  #   iCfg: The running scheduler configuration
+  #   newCfg: The new scheduler configuration
+# /
+def releaseReservations(ledger, iCfg, newCfg):
+  for ss, reserved in sorted(ledger.reservations.items()):
+    if newCfg['dataCentresLabel'] != iCfg['dataCentresLabel'] or reserved['dataCentre'] not in newCfg['noPrimaryDataCentres']:
+      logging.info("Releasing the reservation of %s in %s, the configuration no longer allows it" % (reserved['pod'], reserved['dataCentre']))
+      ledger.release(ss)
+
+# /
+  # Description: function to replay a recording offline through the scheduling path. Reports the decision time
+  #   for each pod and whether the placement matches the recorded one.
+  #
+  # Inputs:
+  #   path: Path of the recording
+  #   seed: Seed for `random`, if None the seed from the recording is used
+# /
+def replay(path, seed):
+  header, steps = recorder.load(path)
+  iCfg = header['config']
+  configureLogging(iCfg)
+  random.seed(header['seed'] if seed is None else seed)
+
+  apiClient = client.ApiClient()
+  replayApi = recorder.ReplayApi(apiClient)
+  podTopology = newTopology(iCfg)
+  # the reservations expire on the recorded time of the events rather than the time of the replay
+  eventTime = [time.time()]
+  ledger = reservation.ResourceLedger(iCfg.get('reservationTTL', reservation.DEFAULTTTL), clock = lambda: eventTime[0])
+  results = []
+  for step in steps:
+    eventTime[0] = step['event'].get('at', time.time())
+    # configurations reloaded while recording apply from this event on
+    for newCfg in step.get('configs', []):
+      logging.info("Applying the configuration reloaded while recording")
+      applyConfig(iCfg, newCfg, podTopology, ledger)
+    podObject = apiClient._ApiClient__deserialize(step['event']['object'], 'V1Pod')
+    podTopology.updatePod(step['event']['type'], podObject)
+    ledger.updatePod(step['event']['type'], podObject, getTotalResourcesRequested)
+    if not toSchedule(podObject, header['scheduler']):
+      continue
+    if podObject.metadata.owner_references[0].kind != 'StatefulSet':
+      continue
+    replayApi.load(step['calls'])
+    start = time.time()
+    node = schedulePod(podObject, replayApi, iCfg, podTopology, ledger = ledger)
+    elapsed = time.time() - start
+    result = {"pod": podObject.metadata.name, "node": node, "ms": round(elapsed * 1000, 3)}
+    if step['decision'] is not None:
+      result['recorded'] = step['decision']['node']
+      result['recordedMs'] = round(step['decision']['s'] * 1000, 3)
+      result['match'] = node == step['decision']['node']
+    results.append(result)
+    print(json.dumps(result))
+
+  timings = sorted(r['ms'] for r in results)
+  summary = {
+    "pods": len(results),
+    "matched": len([r for r in results if r.get('match') is True]),
+    "mismatched": len([r for r in results if r.get('match') is False]),
+    "totalMs": round(sum(timings), 3),
+    "p50Ms": timings[len(timings) // 2] if timings else None,
+    "maxMs": timings[-1] if timings else None
+  }
+  print(json.dumps(summary))
+  return summary['mismatched'] == 0
+
+# /
+  # Description: function to build the pods for the ordinals of a statefulSet from its pod template. The pods share
+  #   the template's spec and are shallow copies of one pod, as creating client model objects is slow.
+  #
+  # Inputs:
+  #   statefulSet: V1StatefulSet object
+  #   replicas: The number of replicas in the statefulSet
+# /
+def templatePods(statefulSet, replicas):
+  template = statefulSet.spec.template
+  labels = {}
+  if template.metadata is not None and template.metadata.labels is not None:
+    labels = dict(template.metadata.labels)
+  prototype = client.V1Pod(metadata = client.V1ObjectMeta(namespace = statefulSet.metadata.namespace, labels = labels), spec = template.spec)
+  pods = []
+  for ordinal in range(replicas):
+    podObject = copy.copy(prototype)
+    podObject.metadata = copy.copy(prototype.metadata)
+    podObject.metadata.name = "%s-%d" % (statefulSet.metadata.name, ordinal)
+    pods.append(podObject)
+  return pods
+
+# /
+  # Description: function to determine the PV/PVC mapping for a planned pod. PVCs that do not exist yet are taken from
+  #   the PVC templates of the statefulSet.
+  #
+  # Inputs:
+  #   pvs: Dictionary of PV name to PV, e.g. from the cluster cache
+  #   pvcs: Dictionary of PVC name to PVC
+  #   pvcTemplates: PVC templates of the statefulSet
+  #   pod: Name of the pod
+  #   usedPVs: Set of PV names already planned for other pods
+# /
+def planStorage(pvs, pvcs, pvcTemplates, pod, usedPVs):
+  pvMap = {
+    "allocatable": [],
+    "unallocatable": [],
+    "allocated": []
+  }
+  for pvcTemplate in pvcTemplates or []:
+    claimName = "%s-%s" % (pvcTemplate.metadata.name, pod)
+    pvc = pvcs.get(claimName)
+    if pvc is not None and pvc.status.phase == BOUND and pvc.spec.volume_name in pvs:
+      pvMap['allocated'].append({'pvc': pvc, 'pv': pvs[pvc.spec.volume_name]})
+      continue
+    if pvc is None:
+      pvc = copy.copy(pvcTemplate)
+      pvc.metadata = copy.copy(pvcTemplate.metadata)
+      pvc.metadata.name = claimName
+    requested = utils.parse_quantity(pvc.spec.resources.requests['storage'])
+    pvMap['allocatable'].append({'pvc': pvc, 'pv': [pv for pv in pvs.values() if pv.metadata.name not in usedPVs and pv.spec.claim_ref is None and pv.status.phase == AVAILABLE and pv.spec.storage_class_name == pvc.spec.storage_class_name and utils.parse_quantity(pv.spec.capacity['storage']) >= requested]})
+    if len(pvMap['allocatable'][-1]['pv']) == 0:
+      pvMap['unallocatable'].append({'pvc': claimName})
+  return pvMap
+
+# /
+  # Description: function to plan the placement of every member of a statefulSet without making any changes. Each
+  #   ordinal is run through the data centre selection and the filter pipeline against the cluster cache, and the
+  #   placement of the earlier ordinals is taken into account for the later ones. A non-electable member with a
+  #   reservation is planned on its reserved node and PVs if they can still take it. Returns the plan for each ordinal
+  #   with the candidate nodes left after each filter and the reason for any rejection.
+  #
+  # Inputs:
+  #   statefulSet: V1StatefulSet object
+  #   iCfg: The scheduler configuration
+  #   clusterCache: ClusterCache holding the cluster state
+  #   chooser: Source of the random choice of the non-electable data centre
+  #   ledger: ResourceLedger of the resources committed on each node, or None to only use the node capacity
+# /
+def planStatefulSet(statefulSet, iCfg, clusterCache, chooser, ledger = None):
+  start = time.perf_counter()
+  podTopology = clusterCache.topology
+  replicas = statefulSet.spec.replicas if statefulSet.spec.replicas is not None else 1
+  ssPvcs = statefulSet.spec.volume_claim_templates
+  members = []
+  usedPVs = set()
+  memberNames = tuple("%s-%d" % (statefulSet.metadata.name, ordinal) for ordinal in range(replicas))
+  with clusterCache.lock:
+    # selectors and topology keys only used by the plan are dropped afterwards, the index would keep them up to date
+    selectors = set(podTopology.counts)
+    topologyKeys = set(podTopology.domains)
+    if ledger is not None:
+      usedPVs.update(ledger.heldPVs(memberNames))
+    # plan as if the members were being (re)created, so existing members do not count against themselves
+    existing = {}
+    for ordinal in range(replicas):
+      pod = "%s-%d" % (statefulSet.metadata.name, ordinal)
+      if pod in podTopology.pods:
+        existing[pod] = podTopology.pods[pod]
+        podTopology.removePod(pod)
+    try:
+      for ordinal, podObject in enumerate(templatePods(statefulSet, replicas)):
+        pod = podObject.metadata.name
+        requestedCPU, requestedMem = getTotalResourcesRequested(podObject.spec.containers)
+        # the non-electable member is planned on its reserved node and PVs while they still take it, as when scheduled
+        reserved = None
+        nodes = []
+        if ledger is not None and ordinal == replicas - 1:
+          reserved = ledger.reservation(statefulSet.metadata.name)
+          if reserved is not None and (reserved['pod'] != pod or reserved['dataCentre'] not in iCfg['noPrimaryDataCentres']):
+            reserved = None
+        if reserved is not None:
+          dataCentre = reserved['dataCentre']
+          reservedPVs = dict((name, pv) for name, pv in clusterCache.pvs.items() if name in reserved['pvs'] or pv.spec.claim_ref is not None)
+          context = pipeline.SchedulingContext(podObject, dataCentre, requestedCPU, requestedMem, ssPvcs, iCfg, podTopology, None, lambda context: planStorage(reservedPVs, clusterCache.pvcs, ssPvcs, context.pod, usedPVs), ledger = ledger, exclude = memberNames)
+          candidates = (1 << podTopology.slots[reserved['node']]) if reserved['node'] in podTopology.slots else 0
+          nodes = RESERVEDPLANPIPELINE.run(context, candidates)
+          if not nodes:
+            reserved = None
+        if not nodes:
+          freeCapacity = None
+          if ledger is not None:
+            freeCapacity = lambda dc: dataCentreCapacity(dc, podTopology, ledger, iCfg, requestedCPU, requestedMem, memberNames)
+          dataCentre = findDC(podName = pod, replicas = replicas, primaryDataCentres = iCfg['primaryDataCentres'], noPrimaryDataCentres = iCfg['noPrimaryDataCentres'], chooser = chooser, freeCapacity = freeCapacity)
+          context = pipeline.SchedulingContext(podObject, dataCentre, requestedCPU, requestedMem, ssPvcs, iCfg, podTopology, None, lambda context: planStorage(clusterCache.pvs, clusterCache.pvcs, ssPvcs, context.pod, usedPVs), ledger = ledger, exclude = memberNames)
+          nodes = PIPELINE.run(context)
+        member = {
+          "ordinal": ordinal,
+          "pod": pod,
+          "dataCentre": dataCentre,
+          "node": nodes[0] if nodes else None,
+          "reserved": reserved is not None,
+          "candidates": context.counts,
+          "rejectedBy": context.rejectedBy,
+          "reasons": [],
+          "pvs": []
+        }
+        if context.pvMap is not None:
+          for un in context.pvMap['unallocatable']:
+            member['reasons'].append("Cannot allocate PVC %s" % un['pvc'])
+          for storage in context.pvMap['allocated']:
+            member['pvs'].append({"pvc": storage['pvc'].metadata.name, "pv": storage['pv'].metadata.name, "bound": True})
+        if nodes:
+          if ssPvcs:
+            for storage in assignPVs(context.storage()['allocatable'], podTopology.nodeObjects[nodes[0]]):
+              usedPVs.add(storage['pv'].metadata.name)
+              member['pvs'].append({"pvc": storage['pvc'].metadata.name, "pv": storage['pv'].metadata.name, "bound": False})
+          podTopology.assumePod(pod, nodes[0], podObject.metadata.labels)
+          # the requests of the planned members count against the later ones, under a name of their own as the
+          # members themselves are excluded from the ledger
+          if ledger is not None:
+            ledger.usePod(PLANNED % pod, nodes[0], requestedCPU, requestedMem)
+        else:
+          member['reasons'].append("No nodes in data centre %s remaining after filter %s" % (dataCentre, context.rejectedBy))
+        members.append(member)
+    finally:
+      for member in members:
+        if member['node'] is not None:
+          podTopology.removePod(member['pod'])
+          if ledger is not None:
+            ledger.releasePod(PLANNED % member['pod'])
+      for pod, placed in existing.items():
+        podTopology.assumePod(pod, placed['node'], placed['labels'])
+      for selector in [selector for selector in podTopology.counts if selector not in selectors]:
+        podTopology.removeSelector(selector)
+      for key in [key for key in podTopology.domains if key not in topologyKeys]:
+        podTopology.removeKey(key)
+  return {
+    "statefulSet": statefulSet.metadata.name,
+    "replicas": replicas,
+    "placeable": all(member['node'] is not None for member in members),
+    "members": members,
+    "ms": round((time.perf_counter() - start) * 1000, 3)
+  }
+
+# /
+  # Description: function to create the handler for the plan endpoint, which takes a statefulSet manifest (YAML or JSON)
+  #   and returns its placement plan. The most recently used manifests are kept deserialized, as capacity planning tends
+  #   to submit the same manifests repeatedly while the cluster state changes.
+  #
+  # Inputs:
+  #   iCfg: The scheduler configuration
+  #   clusterCache: ClusterCache holding the cluster state
+  #   ledger: ResourceLedger of the resources committed on each node, or None to only use the node capacity
+# /
+def planHandler(iCfg, clusterCache, ledger = None):
+  apiClient = client.ApiClient()
+  chooser = random.Random()
+  manifests = collections.OrderedDict()
+  # plans are served by concurrent request threads
+  manifestsLock = threading.Lock()
+  def handler(query, body):
+    with manifestsLock:
+      statefulSet = manifests.get(body)
+      if statefulSet is not None:
+        manifests.move_to_end(body)
+    if statefulSet is None:
+      if body.lstrip().startswith(b'{'):
+        manifest = json.loads(body.decode('utf-8'))
+      else:
+        manifest = yaml.load(body, Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+      if not isinstance(manifest, dict) or manifest.get('kind') != 'StatefulSet':
+        raise ValueError("A StatefulSet manifest is required")
+      statefulSet = apiClient._ApiClient__deserialize(manifest, 'V1StatefulSet')
+      if statefulSet.metadata.namespace is None:
+        statefulSet.metadata.namespace = iCfg['namespace']
+      with manifestsLock:
+        manifests[body] = statefulSet
+        if len(manifests) > MAXMANIFESTS:
+          manifests.popitem(last = False)
+    return planStatefulSet(statefulSet, iCfg, clusterCache, chooser, ledger)
+  return handler
+
+# /
+  # Description: function to return the reservations for the debug endpoint, taken under the cluster cache lock as the
+  #   ledger is changed by the scheduling loop.
+  #
+  # Inputs:
+  #   ledger: ResourceLedger holding the reservations
+  #   clusterCache: ClusterCache holding the lock
+# /
+def reservationSnapshot(ledger, clusterCache):
+  with clusterCache.lock:
+    return ledger.snapshot()
+
+# /
+  # Description: function to create the API gateway from the scheduler configuration.
+  #
+  # Inputs:
+  #   iCfg: The scheduler configuration
+# /
+def newGateway(iCfg):
+  return gateway.ApiGateway(
+    qps = iCfg.get('apiQPS', gateway.DEFAULTQPS),
+    burst = iCfg.get('apiBurst', gateway.DEFAULTBURST),
+    timeout = iCfg.get('apiTimeout', gateway.DEFAULTTIMEOUT),
+    poolSize = iCfg.get('apiPoolSize', gateway.DEFAULTPOOLSIZE)
+  )
+
+# /
+  # Description: function to print the placement plan for a statefulSet manifest using the current cluster state.
+  #   Only reads are made to the API server.
+  #
+  # Inputs:
+  #   path: Path of the statefulSet manifest
+  #   iCfg: The scheduler configuration
+# /
+def plan(path, iCfg):
+  try:
+    config.load_incluster_config()
+  except config.ConfigException:
+    config.load_kube_config()
+  apiGateway = newGateway(iCfg)
+  podTopology = newTopology(iCfg)
+  clusterCache = cache.ClusterCache(apiGateway, podTopology, iCfg['namespace'])
+  clusterCache.refresh()
+  ledger = reservation.ResourceLedger(0)
+  for livePod in apiGateway.list_namespaced_pod(iCfg['namespace']).items:
+    podTopology.updatePod('ADDED', livePod)
+    ledger.updatePod('ADDED', livePod, getTotalResourcesRequested)
+  with open(path, 'rb') as f:
+    result = planHandler(iCfg, clusterCache, ledger)({}, f.read())
+  print(json.dumps(result, indent = 2))
+  return result['placeable']
+
 def main():
+  startup.CLOCK.mark('modules')
+
+  parser = argparse.ArgumentParser(description = 'MongoDB scheduler for statefulSets')
+  parser.add_argument('--config', default = '/init/mongoScheduler.yaml', help = 'Path of the scheduler configuration')
+  parser.add_argument('--replay', metavar = 'FILE', help = 'Replay a recording offline instead of scheduling')
+  parser.add_argument('--seed', type = int, help = 'Seed for the non-electable data centre choice when replaying')
+  parser.add_argument('--plan', metavar = 'FILE', help = 'Print the placement plan for a statefulSet manifest without scheduling')
+  args = parser.parse_args()
+
+  if args.replay:
+    exit(0 if replay(args.replay, args.seed) else 1)
 
   # name of the scheduler
   scheduler_name = os.getenv('SNAME')
 
-  with open('/init/mongoScheduler.yaml', 'r') as f:
-    iCfg = safe_load(f)
+  with open(args.config, 'r') as f:
+    iCfg = yaml.safe_load(f)
     f.close()
 
-  # Determine logging level
-  if iCfg['logLevel'].upper() == 'DEBUG':
-    logLevel = logging.DEBUG
-  else:
-    logLevel = logging.INFO
-  logging.basicConfig(format='{"ts": "%(asctime)s, "f": "%(funcName)s", "l": %(lineno)d, "msg": "%(message)s"}', level=logLevel)
+  validateConfig(iCfg)
+  configureLogging(iCfg)
+  startup.CLOCK.mark('config')
+
+  if args.plan:
+    exit(0 if plan(args.plan, iCfg) else 1)
 
   # Record our configuration settings
   logging.debug("Config: %s" % iCfg)
 
   # configure the API client
   config.load_incluster_config()
-  v1 = client.CoreV1Api()
+  apiGateway = newGateway(iCfg)
+  apiV1 = apiGateway
+  startup.CLOCK.mark('apiClient')
+
+  # Capture the events and API responses if requested
+  capture = None
+  if iCfg.get('recordFile'):
+    seed = random.randrange(2**32)
+    random.seed(seed)
+    capture = recorder.Recorder(iCfg['recordFile'], seed, iCfg, scheduler_name)
+    apiV1 = recorder.RecordingApi(apiGateway, capture)
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+    atexit.register(capture.close)
+
+  # Index of the topology domains, kept up to date from the node lists and the pod watch
+  podTopology = newTopology(iCfg)
+  clusterCache = cache.ClusterCache(apiGateway, podTopology, iCfg['namespace'])
+  flightRecorder = debug.FlightRecorder(iCfg.get('flightRecorderSize', debug.DEFAULTSIZE), apiGateway.threadCalls)
+  # Resources committed on each node and the reservations for the non-electable members
+  ledger = reservation.ResourceLedger(iCfg.get('reservationTTL', reservation.DEFAULTTTL))
 
-  # Watch the stream for changes to pods for the namespace
+  # Serve the local endpoints if requested
+  if iCfg.get('httpPort'):
+    localServer = server.LocalServer(iCfg['httpPort'], iCfg.get('httpAddress', server.DEFAULTADDRESS))
+    localServer.route('POST', '/plan', planHandler(iCfg, clusterCache, ledger))
+    localServer.route('GET', '/debug/decisions', lambda query, body: flightRecorder.recent(int(query.get('limit', ['0'])[0]), query.get('pod', [None])[0]))
+    localServer.route('GET', '/debug/api', lambda query, body: apiGateway.stats())
+    localServer.route('GET', '/debug/startup', lambda query, body: startup.CLOCK.breakdown())
+    localServer.route('GET', '/debug/reservations', lambda query, body: reservationSnapshot(ledger, clusterCache))
+    localServer.route('GET', '/debug/stacks', lambda query, body: (200, 'text/plain', debug.sampleStacks(seconds = float(query.get('seconds', ['5'])[0]), interval = float(query.get('interval', [debug.DEFAULTINTERVAL])[0]))))
+    localServer.start()
+    clusterCache.start(iCfg.get('cacheRefresh', cache.DEFAULTREFRESH))
+
+  # Apply changes to the configuration without restarting
+  if iCfg.get('configReload', reloader.DEFAULTINTERVAL):
+    configWatcher = reloader.ConfigWatcher(args.config, lambda newCfg: reloadConfig(iCfg, newCfg, clusterCache, ledger, capture), iCfg.get('configReload', reloader.DEFAULTINTERVAL))
+    configWatcher.start()
+
+  # Watch the stream for changes to pods for the namespace, the long lived watch bypasses the rate limit and timeout
+  startup.CLOCK.mark('setup')
   w = watch.Watch()
-  for event in w.stream(v1.list_namespaced_pod, iCfg['namespace']):
-    if event['object'].status.phase == "Pending" and event['object'].spec.scheduler_name == scheduler_name and event['object'].status.conditions is None:
+  for event in w.stream(apiGateway.core.list_namespaced_pod, iCfg['namespace']):
+    if capture is not None:
+      capture.event(event)
+    if startup.CLOCK.mark('watch'):
+      logging.info("Watching pods, startup: %s" % startup.CLOCK.summary())
+    with clusterCache.lock:
+      podTopology.updatePod(event['type'], event['object'])
+      ledger.updatePod(event['type'], event['object'], getTotalResourcesRequested)
+    if toSchedule(event['object'], scheduler_name):
       if event['object'].metadata.owner_references[0].kind == 'StatefulSet':
-        # record pod name
-        pod = event['object'].metadata.name
-        logging.debug("Pod: %s" % pod)
-
-        # records the statfulSet name
-        ss = event['object'].metadata.owner_references[0].name
-        logging.debug("StatefulSet: %s, Pod: %s" % (ss, pod))
-
-        # pod affinity items for pod
-        podAffinity = event['object'].spec.affinity
-        logging.debug("Affinity: %s" % podAffinity)
-
-        requestedCPU, requestedMem = getTotalResourcesRequested(event['object'].spec.containers)
-        logging.debug("Requests: cpu: %s, mem: %s" % (requestedCPU, requestedMem))
-
-        # determine how many replicas and PVCs in the statefulSet
-        replicas, ssPvcs = statefulSetCheck(stateful_set = ss, namespace = iCfg['namespace'])
-        logging.debug("Number of replicas in statefulSet: %s" % replicas)
-        logging.debug("PVCs in statefulSet: %s" % ssPvcs)
-
-        # Get the current pods deployed in the namespace.
-        allPods = getAllPods(apiClient = v1, namespace = iCfg['namespace'])
-        for livePod in allPods.items:
-          logging.debug("Current pod: %s" % livePod.metadata.name)
-
-        ## Get the current pods deployed in the statefulSet and what nodes they are running on.
-        #ssPods = getSSPods(allPods, searchKey = "app", searchValue = ss)
-        #logging.debug("Current pods deployed for statefulSet: %s" % ssPods)
-
-        # determine which data centre to assign to the pod to
-        dataCentreSelected = findDC(podName = pod, replicas = replicas, primaryDataCentres = iCfg['primaryDataCentres'], noPrimaryDataCentres = iCfg['noPrimaryDataCentres'])
-        logging.debug("Selected data centre: %s" % dataCentreSelected)
-
-        # Determine the available nodes for the data centre selected.
-        nodesAvailable = nodes_available(apiClient = v1, dataCentre = dataCentreSelected, dataCentresLabel = iCfg['dataCentresLabel'])
-        for node in nodesAvailable.items:
-          logging.debug("Available nodes for data centre %s: %s" % (dataCentreSelected, node.metadata.name))
-
-        # Apply affinity and antiaffinity for available nodes
-        suitableNodes = getAffinityNodes(podAffinity, nodesAvailable, allPods, pod)
-
-        # Calculate score for each available node within the affinity/anti-affinity group
-        sortedScoredNodes = scoreNodes(suitableNodes, requestedCPU, requestedMem)
-        logging.debug("Scored available nodes: %s" % sortedScoredNodes)
-
-        storageOK = False
-        if ssPvcs:
-          storageOK = manageStorage(apiClient = v1, statefulSetPVCs = ssPvcs, nodes = sortedScoredNodes, pod = pod, namespace = iCfg['namespace'])
-        else:
-          logging.info("No PVCs required")
-          storageOK = True
-
-        try:
-          if len(sortedScoredNodes) > 0 and storageOK is True:
-            logging.info("Selected node: %s" % sortedScoredNodes[0].metadata.name)
-            res = scheduler(apiClient = v1, bindingName = event['object'].metadata.name, targetName = sortedScoredNodes[0].metadata.name, namespace = iCfg['namespace'])
-            logging.debug("Bind result: %s" % res)
-            logging.info("Pod %s is bound to node %s" % (pod, sortedScoredNodes[0].metadata.name))
-          else:
-            logging.error("Cannot schedule")
-        except client.rest.ApiException as e:
-            logging.error(json.loads(e.body)['message'])
+        start = time.time()
+        node = schedulePod(event['object'], apiV1, iCfg, podTopology, flightRecorder, ledger, clusterCache.lock)
+        if capture is not None:
+          capture.decision(event['object'].metadata.name, node, time.time() - start)
+        if startup.CLOCK.mark('firstDecision'):
+          logging.info("First decision made, startup: %s" % startup.CLOCK.summary())
+        logging.debug("API calls: %s" % apiGateway.stats())
       else:
         logging.warn("This scheduler is only for statefulSets")
                     
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
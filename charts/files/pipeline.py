@@ -0,0 +1,149 @@
+try:
+  import logging
+  import threading
+  import time
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# /
+  # Description: Returns the slot indexes of the bits set in a candidate set, lowest first.
+  #
+  # Inputs:
+  #   mask: Candidate set as an integer bitset over the node array of the TopologyIndex
+# /
+def bits(mask):
+  while mask:
+    low = mask & -mask
+    yield low.bit_length() - 1
+    mask ^= low
+
+# /
+  # Description: Returns the number of bits set in a candidate set.
+  #
+  # Inputs:
+  #   mask: Candidate set as an integer bitset
+# /
+def count(mask):
+  return bin(mask).count('1')
+
+# /
+  # Description: State of a single scheduling decision passed through the plugins of a Pipeline.
+  #   Plugins record what they compute (e.g. scores) on it so later plugins and the binding can use it.
+  #
+  # Inputs:
+  #   podObject: Pod object to place
+  #   dataCentre: Data centre selected for the pod
+  #   requestedCPU: Total CPU requested by the pod
+  #   requestedMem: Total memory requested by the pod
+  #   ssPvcs: PVC templates of the statefulSet
+  #   iCfg: The scheduler configuration
+  #   topology: TopologyIndex holding the node array
+  #   apiClient: The API gateway
+  #   storageLoader: Function called with the context to load the PV/PVC mapping, only called if needed
+  #   ledger: ResourceLedger of the resources committed on each node, or None to only use the node capacity
+  #   exclude: Names of pods not counted against the nodes by the ledger, the pod itself by default
+  #   lock: Lock held while the TopologyIndex and ledger are read, e.g. the ClusterCache lock, by default a lock of
+  #     the decision's own
+# /
+class SchedulingContext(object):
+
+  def __init__(self, podObject, dataCentre, requestedCPU, requestedMem, ssPvcs, iCfg, topology, apiClient, storageLoader, ledger = None, exclude = None, lock = None):
+    self.podObject = podObject
+    self.pod = podObject.metadata.name
+    self.dataCentre = dataCentre
+    self.requestedCPU = requestedCPU or 0
+    self.requestedMem = requestedMem or 0
+    self.ssPvcs = ssPvcs
+    self.iCfg = iCfg
+    self.topology = topology
+    self.apiClient = apiClient
+    self.storageLoader = storageLoader
+    self.ledger = ledger
+    self.exclude = exclude if exclude is not None else (self.pod,)
+    self.lock = lock if lock is not None else threading.RLock()
+    self.pvMap = None
+    self.scores = {}
+    # list of (plugin name, candidates remaining) in the order the plugins ran
+    self.counts = []
+    # plugin name -> seconds
+    self.timings = {}
+    self.rejectedBy = None
+
+  # /
+    # Description: Returns the PV/PVC mapping for the pod, loading it on first use.
+  # /
+  def storage(self):
+    if self.pvMap is None:
+      self.pvMap = self.storageLoader(self)
+    return self.pvMap
+
+# /
+  # Description: Runs the filter plugins in order over a candidate set of nodes, stopping as soon as no candidates
+  #   remain, then orders the remaining nodes with the score plugin. Filters are called as
+  #   `plugin.filter(context, candidates)` and return the new candidate set, the score plugin is called as
+  #   `plugin.score(context, candidates)` and returns slot indexes best first. Each plugin is timed.
+  #   The cheapest and most selective filters should come first. The plugins run holding the lock of the context,
+  #   filters with a `plugin.prepare(context)` method have it called first with the lock released, so what they
+  #   need from the API server is loaded without holding up the other users of the lock.
+  #
+  # Inputs:
+  #   filters: Array of filter plugins
+  #   scorer: Score plugin
+# /
+class Pipeline(object):
+
+  def __init__(self, filters, scorer):
+    self.filters = filters
+    self.scorer = scorer
+
+  # /
+    # Description: Run the pipeline for a decision. Returns the node names ordered best first.
+    #
+    # Inputs:
+    #   context: SchedulingContext of the decision
+    #   candidates: Initial candidate set, by default every node in the node array
+  # /
+  def run(self, context, candidates = None):
+    with context.lock:
+      if candidates is None:
+        candidates = context.topology.allMask
+      for plugin in self.filters:
+        start = time.perf_counter()
+        if hasattr(plugin, 'prepare'):
+          candidates = self.prepare(plugin, context, candidates)
+        candidates = plugin.filter(context, candidates)
+        context.timings[plugin.name] = time.perf_counter() - start
+        context.counts.append((plugin.name, count(candidates)))
+        logging.debug("Filter %s: %s candidate nodes for pod %s" % (plugin.name, count(candidates), context.pod))
+        if not candidates:
+          context.rejectedBy = plugin.name
+          logging.info("No nodes remaining for pod %s after filter %s" % (context.pod, plugin.name))
+          return []
+      start = time.perf_counter()
+      ordered = self.scorer.score(context, candidates)
+      context.timings[self.scorer.name] = time.perf_counter() - start
+      return [context.topology.nodeArray[i] for i in ordered]
+
+  # /
+    # Description: Call the prepare method of a plugin with the lock of the context released. The candidates are
+    #   held by node name meanwhile, as the slot of a node removed by another thread can be reused, and nodes removed
+    #   meanwhile are dropped. Returns the candidate set.
+    #
+    # Inputs:
+    #   plugin: Filter plugin
+    #   context: SchedulingContext of the decision
+    #   candidates: Candidate set
+  # /
+  def prepare(self, plugin, context, candidates):
+    names = [context.topology.nodeArray[i] for i in bits(candidates)]
+    context.lock.release()
+    try:
+      plugin.prepare(context)
+    finally:
+      context.lock.acquire()
+    candidates = 0
+    for name in names:
+      if name in context.topology.slots:
+        candidates |= 1 << context.topology.slots[name]
+    return candidates
@@ -0,0 +1,284 @@
+try:
+  import collections
+  import gzip
+  import json
+  import logging
+  import threading
+  import time
+  import zlib
+  from kubernetes import client
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+CALL = "call"
+CONFIG = "config"
+DECISION = "decision"
+EVENT = "event"
+HEADER = "header"
+VERSION = 1
+WRITEPREFIXES = ("create_", "delete_", "patch_", "replace_")
+
+# /
+  # Description: Writes the pod watch events, the API server responses and the scheduling decisions
+  #   to a gzip compressed file of JSON lines so they can be replayed offline.
+  #
+  # Inputs:
+  #   path: Path of the file to write
+  #   seed: Seed used for `random`, so the non-electable data centre choice can be reproduced
+  #   iCfg: The scheduler configuration
+  #   schedulerName: Name of the scheduler
+# /
+class Recorder(object):
+
+  def __init__(self, path, seed, iCfg, schedulerName):
+    self.path = path
+    self.fh = gzip.open(path, 'wt')
+    # the configuration is recorded from the config watcher thread
+    self.lock = threading.Lock()
+    self.apiClient = client.ApiClient()
+    self.write({"t": HEADER, "v": VERSION, "seed": seed, "config": iCfg, "scheduler": schedulerName})
+    logging.info("Recording scheduler events to %s" % path)
+
+  def write(self, record):
+    line = json.dumps(record, separators = (',', ':'), default = str) + '\n'
+    with self.lock:
+      self.fh.write(line)
+
+  # /
+    # Description: Record a pod watch event and when it was received, so time dependent state (e.g. reservations
+    #   expiring) can be replayed on the recorded time.
+    #
+    # Inputs:
+    #   event: Event from the watch stream
+  # /
+  def event(self, event):
+    raw = event.get('raw_object')
+    if raw is None:
+      raw = self.apiClient.sanitize_for_serialization(event['object'])
+    self.write({"t": EVENT, "type": event['type'], "object": raw, "at": round(time.time(), 3)})
+
+  # /
+    # Description: Record an API call and its response (or the ApiException it raised).
+    #
+    # Inputs:
+    #   method: Name of the API method
+    #   response: Response object, or None
+    #   error: ApiException raised by the call, or None
+  # /
+  def call(self, method, response, error = None):
+    record = {"t": CALL, "m": method}
+    if error is not None:
+      record['status'] = error.status
+      record['reason'] = error.reason
+      record['body'] = error.body
+    elif response is not None and hasattr(response, 'openapi_types'):
+      record['k'] = type(response).__name__
+      record['r'] = self.apiClient.sanitize_for_serialization(response)
+    self.write(record)
+
+  # /
+    # Description: Record the outcome of a scheduling decision and flush so the file is usable if the
+    #   scheduler is stopped.
+    #
+    # Inputs:
+    #   pod: Name of the pod
+    #   node: Name of the selected node, or None if the pod could not be scheduled
+    #   elapsed: Decision time in seconds
+  # /
+  def decision(self, pod, node, elapsed):
+    self.write({"t": DECISION, "pod": pod, "node": node, "s": round(elapsed, 6)})
+    with self.lock:
+      self.fh.flush()
+
+  # /
+    # Description: Record a configuration reload, it applies from the next pod watch event on.
+    #
+    # Inputs:
+    #   iCfg: The scheduler configuration after the reload
+  # /
+  def config(self, iCfg):
+    self.write({"t": CONFIG, "config": iCfg})
+    with self.lock:
+      self.fh.flush()
+
+  def close(self):
+    with self.lock:
+      self.fh.close()
+
+# /
+  # Description: Wraps a Kubernetes API object so every call made through it is recorded.
+  #
+  # Inputs:
+  #   api: API object to wrap (e.g. CoreV1Api)
+  #   recorder: Recorder object
+# /
+class RecordingApi(object):
+
+  def __init__(self, api, recorder):
+    self.api = api
+    self.recorder = recorder
+
+  def __getattr__(self, name):
+    attr = getattr(self.api, name)
+    if not callable(attr):
+      return attr
+    def recordedCall(*args, **kwargs):
+      try:
+        response = attr(*args, **kwargs)
+      except client.rest.ApiException as e:
+        self.recorder.call(name, None, e)
+        raise
+      self.recorder.call(name, response)
+      return response
+    return recordedCall
+
+# /
+  # Description: Returns the complete lines of a recording. A recording from a scheduler that was killed has no gzip
+  #   trailer and can end part way through a line, everything up to the last flush is still read and the cut short
+  #   line is dropped.
+  #
+  # Inputs:
+  #   path: Path of the recording
+# /
+def readLines(path):
+  with open(path, 'rb') as fh:
+    data = fh.read()
+  chunks = []
+  complete = True
+  # a gzip file can hold several members, each is decompressed in turn
+  while data:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+      chunks.append(decompressor.decompress(data))
+    except zlib.error as e:
+      logging.warn("Recording %s is corrupt after %s bytes: %s" % (path, sum(len(chunk) for chunk in chunks), e))
+      complete = False
+      break
+    if not decompressor.eof:
+      complete = False
+      break
+    data = decompressor.unused_data
+  lines = b''.join(chunks).decode('utf-8').split('\n')
+  if lines[-1]:
+    complete = False
+  if not complete:
+    logging.warn("Recording %s was not closed, reading it up to the last complete line" % path)
+  return [line for line in lines[:-1] if line]
+
+# /
+  # Description: Reads a recording and groups it into the header and one entry per pod watch event holding
+  #   the event, the API calls made while handling it, the recorded decision (if any) and the configurations
+  #   reloaded since the previous event.
+  #
+  # Inputs:
+  #   path: Path of the recording
+# /
+def load(path):
+  header = None
+  steps = []
+  configs = []
+  for line in readLines(path):
+    record = json.loads(line)
+    if record['t'] == HEADER:
+      header = record
+    elif record['t'] == CONFIG:
+      configs.append(record['config'])
+    elif record['t'] == EVENT:
+      steps.append({"event": record, "calls": [], "decision": None, "configs": configs})
+      configs = []
+    elif record['t'] == CALL and steps:
+      steps[-1]['calls'].append(record)
+    elif record['t'] == DECISION and steps:
+      steps[-1]['decision'] = record
+  if header is None or header.get('v') != VERSION:
+    raise ValueError("%s is not a recording this scheduler can replay" % path)
+  return header, steps
+
+# /
+  # Description: Returns the name of the object in a call record, or None if the record holds no object.
+  #
+  # Inputs:
+  #   record: Call record
+# /
+def recordName(record):
+  return ((record.get('r') or {}).get('metadata') or {}).get('name')
+
+# /
+  # Description: Serves recorded API responses in place of the API server. Responses recorded while handling
+  #   the current event are served in order per method. If the scheduling path asks for something that was
+  #   not recorded for this event the latest recorded response of the method is used. Single object reads
+  #   are only answered with an object of the requested name, from the latest read or the latest list. Writes are never sent anywhere and are kept in `writes`.
+  #
+  # Inputs:
+  #   apiClient: Kubernetes ApiClient used to deserialize recorded objects
+# /
+class ReplayApi(object):
+
+  def __init__(self, apiClient):
+    self.apiClient = apiClient
+    self.pending = {}
+    self.latest = {}
+    self.writes = []
+
+  # /
+    # Description: Load the calls recorded for the next event.
+    #
+    # Inputs:
+    #   calls: Array of call records
+  # /
+  def load(self, calls):
+    self.pending = {}
+    self.writes = []
+    for record in calls:
+      self.pending.setdefault(record['m'], collections.deque()).append(record)
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    def replayedCall(*args, **kwargs):
+      if name.startswith(WRITEPREFIXES):
+        self.writes.append({"m": name, "args": args})
+        queue = self.pending.get(name)
+        record = queue.popleft() if queue else None
+        if record is not None and 'status' in record:
+          self.raiseRecorded(record)
+        return None
+      queue = self.pending.get(name)
+      if queue:
+        record = queue.popleft()
+        if 'status' in record:
+          self.raiseRecorded(record)
+        self.latest[name] = record
+        return self.deserialize(record)
+      if name.startswith('read_'):
+        # a single object read is only answered with an object of the requested name
+        objectName = args[0] if args else kwargs.get('name')
+        if name in self.latest and recordName(self.latest[name]) == objectName:
+          return self.deserialize(self.latest[name])
+        return self.readFromList(name, objectName)
+      if name in self.latest:
+        return self.deserialize(self.latest[name])
+      raise client.rest.ApiException(status = 0, reason = "No recorded response for %s" % name)
+    return replayedCall
+
+  def readFromList(self, name, objectName):
+    listName = 'list_' + name[len('read_'):]
+    if listName in self.pending and self.pending[listName]:
+      self.latest[listName] = self.pending[listName][0]
+    if listName in self.latest:
+      for item in self.deserialize(self.latest[listName]).items:
+        if item.metadata.name == objectName:
+          return item
+    raise client.rest.ApiException(status = 404, reason = "%s not found in recording" % objectName)
+
+  def raiseRecorded(self, record):
+    e = client.rest.ApiException(status = record['status'], reason = record.get('reason'))
+    e.body = record.get('body')
+    raise e
+
+  def deserialize(self, record):
+    if 'k' not in record:
+      return None
+    return self.apiClient._ApiClient__deserialize(record['r'], record['k'])
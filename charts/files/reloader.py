@@ -0,0 +1,68 @@
+try:
+  import hashlib
+  import logging
+  import threading
+  import time
+  import yaml
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+DEFAULTINTERVAL = 10
+
+# /
+  # Description: Watches a configuration file, such as one mounted from a ConfigMap, and calls a function with the new
+  #   configuration whenever the content of the file changes. The file is compared by content rather than modification
+  #   time as Kubernetes replaces mounted ConfigMap files through a symlink. A change that fails to load or apply is
+  #   logged and not retried until the file changes again.
+  #
+  # Inputs:
+  #   path: Path of the configuration file
+  #   onChange: Function called with the new configuration
+  #   interval: Seconds between checks of the file
+# /
+class ConfigWatcher(object):
+
+  def __init__(self, path, onChange, interval = DEFAULTINTERVAL):
+    self.path = path
+    self.onChange = onChange
+    self.interval = interval
+    self.digest = self.fingerprint()[0]
+
+  def fingerprint(self):
+    try:
+      with open(self.path, 'rb') as f:
+        data = f.read()
+    except IOError as e:
+      logging.error("Cannot read configuration %s: %s" % (self.path, e))
+      return None, None
+    return hashlib.sha1(data).hexdigest(), data
+
+  # /
+    # Description: Check the file once and apply the configuration if it has changed.
+  # /
+  def check(self):
+    digest, data = self.fingerprint()
+    if digest is None or digest == self.digest:
+      return False
+    self.digest = digest
+    logging.info("Configuration %s changed" % self.path)
+    try:
+      self.onChange(yaml.safe_load(data))
+    except Exception as e:
+      logging.error("Configuration not applied: %s" % e)
+      return False
+    return True
+
+  # /
+    # Description: Check the file in a background thread.
+  # /
+  def start(self):
+    def watchLoop():
+      while True:
+        time.sleep(self.interval)
+        self.check()
+    thread = threading.Thread(target = watchLoop, name = 'config')
+    thread.daemon = True
+    thread.start()
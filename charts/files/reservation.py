@@ -0,0 +1,203 @@
+try:
+  import logging
+  import time
+  import topology
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+DEFAULTTTL = 600
+
+# /
+  # Description: Ledger of the CPU and memory committed on each node, made up of the requests of the pods placed on
+  #   the node and the reservations held for the non-electable member of each statefulSet. A reservation holds the
+  #   node, requests and PVs of the member while it is not running (not yet created, or deleted and being recreated)
+  #   so other members cannot take them, and expires if the member is not placed within the time to live. A
+  #   reservation is only counted against its node while its member is not placed, as the member's own requests are
+  #   counted once it is. Like the TopologyIndex it is not thread safe, the ClusterCache lock must be held.
+  #
+  # Inputs:
+  #   ttl: Seconds a reservation is held for while its member is not placed
+  #   clock: Function returning the current time in seconds
+# /
+class ResourceLedger(object):
+
+  def __init__(self, ttl = DEFAULTTTL, clock = time.time):
+    self.ttl = ttl
+    self.clock = clock
+    # pod name -> (node name, cpu, memory)
+    self.pods = {}
+    # node name -> [cpu, memory] requested by the pods placed on the node
+    self.used = {}
+    # statefulSet name -> reservation
+    self.reservations = {}
+
+  # /
+    # Description: Update the ledger from a pod watch event. Only pods assigned to a node and not terminated are counted.
+    #
+    # Inputs:
+    #   eventType: Type of the watch event, e.g. ADDED, MODIFIED or DELETED
+    #   pod: V1Pod object from the event
+    #   requests: Function returning the total cpu and memory requested by an array of containers
+  # /
+  def updatePod(self, eventType, pod, requests):
+    name = pod.metadata.name
+    nodeName = pod.spec.node_name if pod.spec is not None else None
+    if eventType == 'DELETED' or nodeName is None or (pod.status is not None and pod.status.phase in topology.TERMINATED):
+      self.releasePod(name)
+      return
+    current = self.pods.get(name)
+    if current is not None and current[0] == nodeName:
+      return
+    cpu, mem = requests(pod.spec.containers)
+    self.usePod(name, nodeName, cpu, mem)
+
+  # /
+    # Description: Record a pod as placed on a node, e.g. straight after binding and before the watch reports it.
+    #
+    # Inputs:
+    #   name: Name of the pod
+    #   nodeName: Name of the node the pod is placed on
+    #   cpu: CPU requested by the pod
+    #   mem: Memory requested by the pod
+  # /
+  def usePod(self, name, nodeName, cpu, mem):
+    self.releasePod(name)
+    cpu = cpu or 0
+    mem = mem or 0
+    self.pods[name] = (nodeName, cpu, mem)
+    used = self.used.setdefault(nodeName, [0, 0])
+    used[0] += cpu
+    used[1] += mem
+    for statefulSet, reserved in list(self.reservations.items()):
+      if reserved['pod'] == name and reserved['node'] != nodeName:
+        logging.warn("Pod %s placed on %s rather than its reserved node %s, releasing the reservation" % (name, nodeName, reserved['node']))
+        del self.reservations[statefulSet]
+
+  # /
+    # Description: Remove a pod from the ledger. The reservation of the pod, if any, is held from now on.
+    #
+    # Inputs:
+    #   name: Name of the pod
+  # /
+  def releasePod(self, name):
+    current = self.pods.pop(name, None)
+    if current is None:
+      return
+    nodeName, cpu, mem = current
+    used = self.used[nodeName]
+    used[0] -= cpu
+    used[1] -= mem
+    for reserved in self.reservations.values():
+      if reserved['pod'] == name:
+        reserved['expires'] = self.clock() + self.ttl
+        logging.info("Holding reservation of %s on node %s for %ss" % (name, reserved['node'], self.ttl))
+
+  # /
+    # Description: Reserve a node, resources and PVs for the non-electable member of a statefulSet, replacing any
+    #   existing reservation for the statefulSet.
+    #
+    # Inputs:
+    #   statefulSet: Name of the statefulSet
+    #   pod: Name of the non-electable member
+    #   dataCentre: Data centre of the node
+    #   nodeName: Name of the reserved node
+    #   pvs: Names of the reserved PVs
+    #   cpu: CPU requested by the member
+    #   mem: Memory requested by the member
+  # /
+  def reserve(self, statefulSet, pod, dataCentre, nodeName, pvs, cpu, mem):
+    self.reservations[statefulSet] = {
+      "statefulSet": statefulSet,
+      "pod": pod,
+      "dataCentre": dataCentre,
+      "node": nodeName,
+      "pvs": sorted(pvs),
+      "cpu": cpu or 0,
+      "mem": mem or 0,
+      "expires": self.clock() + self.ttl
+    }
+    logging.info("Reserved node %s in %s and PVs %s for pod %s" % (nodeName, dataCentre, sorted(pvs), pod))
+    return self.reservations[statefulSet]
+
+  # /
+    # Description: Returns the reservation for the statefulSet, or None if there is none or it has expired.
+    #
+    # Inputs:
+    #   statefulSet: Name of the statefulSet
+  # /
+  def reservation(self, statefulSet):
+    self.expire()
+    return self.reservations.get(statefulSet)
+
+  # /
+    # Description: Release the reservation for the statefulSet.
+    #
+    # Inputs:
+    #   statefulSet: Name of the statefulSet
+  # /
+  def release(self, statefulSet):
+    reserved = self.reservations.pop(statefulSet, None)
+    if reserved is not None:
+      logging.info("Released reservation of %s on node %s" % (reserved['pod'], reserved['node']))
+
+  # /
+    # Description: Drop the reservations whose member has not been placed within the time to live. Returns the names
+    #   of the statefulSets whose reservation expired.
+  # /
+  def expire(self):
+    now = self.clock()
+    expired = [statefulSet for statefulSet, reserved in self.reservations.items() if reserved['pod'] not in self.pods and reserved['expires'] <= now]
+    for statefulSet in expired:
+      logging.info("Reservation of %s on node %s expired" % (self.reservations[statefulSet]['pod'], self.reservations[statefulSet]['node']))
+      del self.reservations[statefulSet]
+    return expired
+
+  # /
+    # Description: Returns the CPU and memory committed on a node by pods and held reservations.
+    #
+    # Inputs:
+    #   nodeName: Name of the node
+    #   exclude: Names of pods whose requests and reservations are not counted, e.g. the pod being placed
+  # /
+  def committed(self, nodeName, exclude = ()):
+    cpu, mem = self.used.get(nodeName, (0, 0))
+    for pod in exclude:
+      placed = self.pods.get(pod)
+      if placed is not None and placed[0] == nodeName:
+        cpu -= placed[1]
+        mem -= placed[2]
+    for reserved in self.reservations.values():
+      if reserved['node'] == nodeName and reserved['pod'] not in self.pods and reserved['pod'] not in exclude:
+        cpu += reserved['cpu']
+        mem += reserved['mem']
+    return cpu, mem
+
+  # /
+    # Description: Returns the names of the PVs held by reservations.
+    #
+    # Inputs:
+    #   exclude: Names of pods whose reservations are not counted, e.g. the pod being placed
+  # /
+  def heldPVs(self, exclude = ()):
+    held = set()
+    for reserved in self.reservations.values():
+      if reserved['pod'] not in exclude:
+        held.update(reserved['pvs'])
+    return held
+
+  # /
+    # Description: Returns the reservations with whether their member is placed and the seconds left before they expire.
+  # /
+  def snapshot(self):
+    self.expire()
+    now = self.clock()
+    reservations = []
+    for statefulSet in sorted(self.reservations):
+      reserved = dict(self.reservations[statefulSet])
+      reserved['placed'] = reserved['pod'] in self.pods
+      reserved['expiresIn'] = None if reserved['placed'] else round(reserved.pop('expires') - now, 3)
+      reserved.pop('expires', None)
+      reservations.append(reserved)
+    return reservations
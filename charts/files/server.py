@@ -0,0 +1,97 @@
+try:
+  import json
+  import logging
+  import threading
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import urlparse, parse_qs
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+DEFAULTADDRESS = "127.0.0.1"
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+# /
+  # Description: Local HTTP server for the scheduler's endpoints. Handlers are registered per method and path and are
+  #   called with the query parameters and the request body. A handler returns an object which is sent as JSON, or
+  #   a (status, object) tuple, or a (status, content type, text) tuple.
+  #
+  # Inputs:
+  #   port: Port to listen on
+  #   address: Address to listen on, local only by default
+# /
+class LocalServer(object):
+
+  def __init__(self, port, address = DEFAULTADDRESS):
+    self.port = port
+    self.address = address
+    self.routes = {}
+
+  # /
+    # Description: Register a handler.
+    #
+    # Inputs:
+    #   method: HTTP method, e.g. GET or POST
+    #   path: Path of the endpoint
+    #   handler: Function called as `handler(query, body)`
+  # /
+  def route(self, method, path, handler):
+    self.routes[(method, path)] = handler
+
+  # /
+    # Description: Start serving in a background thread.
+  # /
+  def start(self):
+    routes = self.routes
+
+    class Handler(BaseHTTPRequestHandler):
+
+      def handle_one(self, method):
+        url = urlparse(self.path)
+        handler = routes.get((method, url.path))
+        if handler is None:
+          self.respond((404, {"error": "not found"}))
+          return
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        try:
+          self.respond(handler(parse_qs(url.query), body))
+        except Exception as e:
+          logging.error("Error handling %s %s: %s" % (method, url.path, e))
+          self.respond((400, {"error": str(e)}))
+
+      def respond(self, result):
+        status = 200
+        contentType = 'application/json'
+        if isinstance(result, tuple) and len(result) == 3:
+          status, contentType, text = result
+        elif isinstance(result, tuple):
+          status, text = result[0], json.dumps(result[1], default = str)
+        else:
+          text = json.dumps(result, default = str)
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def do_GET(self):
+        self.handle_one('GET')
+
+      def do_POST(self):
+        self.handle_one('POST')
+
+      def log_message(self, format, *args):
+        logging.debug("HTTP %s" % (format % args))
+
+    httpd = ThreadingServer((self.address, self.port), Handler)
+    thread = threading.Thread(target = httpd.serve_forever, name = 'http')
+    thread.daemon = True
+    thread.start()
+    logging.info("Listening on %s:%s" % (self.address, self.port))
+    return httpd
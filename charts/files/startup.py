@@ -0,0 +1,77 @@
+try:
+  import logging
+  import os
+  import time
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# /
+  # Description: Returns the seconds since the process started, from /proc, or None if it is not known (e.g. not on
+  #   Linux). The uptime and the start time of the process are both measured from boot.
+# /
+def processAge():
+  try:
+    with open('/proc/self/stat', 'r') as f:
+      # the command name can hold spaces, the fields after it are space separated
+      fields = f.read().rsplit(')', 1)[1].split()
+    with open('/proc/uptime', 'r') as f:
+      uptime = float(f.read().split()[0])
+    return max(uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK'), 0)
+  except (IOError, OSError, IndexError, ValueError):
+    return None
+
+# /
+  # Description: Records how long each phase of start up takes, from the process starting to the first scheduling
+  #   decision. Each phase is recorded the first time it is marked and runs from the previous mark.
+# /
+class StartupClock(object):
+
+  def __init__(self):
+    self.processAge = processAge()
+    self.last = time.perf_counter()
+    # list of (phase, seconds) in the order the phases were marked
+    self.phases = []
+
+  # /
+    # Description: Mark the end of a phase, only the first mark of a phase is kept.
+    #
+    # Inputs:
+    #   phase: Name of the phase
+  # /
+  def mark(self, phase):
+    now = time.perf_counter()
+    if phase in [name for name, seconds in self.phases]:
+      return False
+    self.phases.append((phase, now - self.last))
+    self.last = now
+    logging.debug("Startup phase %s took %.1fms" % (phase, self.phases[-1][1] * 1000))
+    return True
+
+  # /
+    # Description: Returns the start up time breakdown in milliseconds.
+  # /
+  def breakdown(self):
+    interpreter = None
+    if self.processAge is not None:
+      interpreter = round(self.processAge * 1000, 1)
+    phases = [{"phase": name, "ms": round(seconds * 1000, 1)} for name, seconds in self.phases]
+    return {
+      "interpreterMs": interpreter,
+      "phases": phases,
+      "totalMs": round((interpreter or 0) + sum(phase['ms'] for phase in phases), 1)
+    }
+
+  # /
+    # Description: Returns the start up time breakdown as a line of text for the logs.
+  # /
+  def summary(self):
+    breakdown = self.breakdown()
+    parts = []
+    if breakdown['interpreterMs'] is not None:
+      parts.append("interpreter %sms" % breakdown['interpreterMs'])
+    parts.extend("%s %sms" % (phase['phase'], phase['ms']) for phase in breakdown['phases'])
+    return "%s, total %sms" % (", ".join(parts), breakdown['totalMs'])
+
+# The clock starts when this module is first imported, which should be the first thing the scheduler does
+CLOCK = StartupClock()
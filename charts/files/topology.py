@@ -0,0 +1,396 @@
+try:
+  import logging
+except ImportError as e:
+  print(e)
+  exit(1)
+
+# Constants
+DOESNOTEXIST = "DoesNotExist"
+EXISTS = "Exists"
+IN = "In"
+NOTIN = "NotIn"
+TERMINATED = ["Succeeded", "Failed"]
+
+# /
+  # Description: Converts a Kubernetes label selector into a hashable form so it can be used as a dictionary key.
+  #
+  # Inputs:
+  #   labelSelector: V1LabelSelector object (or None)
+# /
+def selectorKey(labelSelector):
+  if labelSelector is None:
+    return ((), ())
+  matchLabels = ()
+  if labelSelector.match_labels:
+    matchLabels = tuple(sorted(labelSelector.match_labels.items()))
+  matchExpressions = ()
+  if labelSelector.match_expressions:
+    matchExpressions = tuple(sorted((e.key, e.operator, tuple(sorted(e.values or []))) for e in labelSelector.match_expressions))
+  return (matchLabels, matchExpressions)
+
+# /
+  # Description: Determines if a set of labels satisfies a selector key created by `selectorKey`.
+  #   All requirements must be met (logical AND), as per Kubernetes.
+  #
+  # Inputs:
+  #   key: Selector key from `selectorKey`
+  #   labels: Dictionary of labels to test
+# /
+def selectorMatches(key, labels):
+  matchLabels, matchExpressions = key
+  if not matchLabels and not matchExpressions:
+    return False
+  for labelKey, labelValue in matchLabels:
+    if labels.get(labelKey) != labelValue:
+      return False
+  for labelKey, operator, values in matchExpressions:
+    if operator == IN:
+      if labelKey not in labels or labels[labelKey] not in values:
+        return False
+    elif operator == NOTIN:
+      if labelKey in labels and labels[labelKey] in values:
+        return False
+    elif operator == EXISTS:
+      if labelKey not in labels:
+        return False
+    elif operator == DOESNOTEXIST:
+      if labelKey in labels:
+        return False
+    else:
+      logging.warn("No valid operator for label selector: %s" % operator)
+      return False
+  return True
+
+# /
+  # Description: Determines if a node reports the Ready condition.
+  #
+  # Inputs:
+  #   node: V1Node object
+# /
+def nodeReady(node):
+  if node.status is None or node.status.conditions is None:
+    return False
+  for status in node.status.conditions:
+    if status.status == "True" and status.type == "Ready":
+      return True
+  return False
+
+# /
+  # Description: Index of the topology domains of the worker nodes and the pods placed within them.
+  #   Nodes are held in a node array and each node has a fixed slot in it, so sets of nodes are integer
+  #   bitsets over the array. For each topology key (e.g. hostname, zone, rack or the data centre label)
+  #   each domain value is mapped to the bitset of its nodes, and for each label selector that has been
+  #   queried the number of matching pods in each domain is kept. Everything is updated incrementally from
+  #   node lists and the pod watch, so affinity, anti-affinity and spread constraints are count lookups
+  #   rather than pod scans.
+  #
+  # Inputs:
+  #   topologyKeys: Array of node label keys to index up front, other keys are indexed on first use
+# /
+class TopologyIndex(object):
+
+  def __init__(self, topologyKeys):
+    # node name -> labels
+    self.nodes = {}
+    # node name -> V1Node object
+    self.nodeObjects = {}
+    # node name -> resourceVersion of the last node object seen
+    self.nodeVersions = {}
+    # node array: slot -> node name (None if the slot is free), and node name -> slot
+    self.nodeArray = []
+    self.slots = {}
+    self.freeSlots = []
+    # bitsets of every node and of the Ready nodes
+    self.allMask = 0
+    self.readyMask = 0
+    # topology key -> domain value -> bitset of nodes
+    self.domains = {}
+    # pod name -> {"node": node name, "labels": labels}
+    self.pods = {}
+    # node name -> set of pod names
+    self.nodePods = {}
+    # selector key -> topology key -> domain value -> count of matching pods
+    self.counts = {}
+    for key in topologyKeys:
+      self.addKey(key)
+
+  # /
+    # Description: Start indexing a topology key.
+    #
+    # Inputs:
+    #   key: Node label key
+  # /
+  def addKey(self, key):
+    if key in self.domains:
+      return
+    logging.debug("Indexing topology key %s" % key)
+    domains = {}
+    for nodeName, labels in self.nodes.items():
+      if key in labels:
+        domains[labels[key]] = domains.get(labels[key], 0) | (1 << self.slots[nodeName])
+    self.domains[key] = domains
+    for selector in self.counts:
+      self.counts[selector][key] = self._buildCounts(selector, key)
+
+  # /
+    # Description: Stop indexing a topology key and drop the pod counts kept for it.
+    #
+    # Inputs:
+    #   key: Node label key
+  # /
+  def removeKey(self, key):
+    if self.domains.pop(key, None) is None:
+      return
+    logging.debug("No longer indexing topology key %s" % key)
+    for keys in self.counts.values():
+      keys.pop(key, None)
+
+  # /
+    # Description: Stop keeping the pod counts for a label selector.
+    #
+    # Inputs:
+    #   selector: Selector key from `selectorKey`
+  # /
+  def removeSelector(self, selector):
+    self.counts.pop(selector, None)
+
+  # /
+    # Description: Synchronise the index with a full list of nodes. Nodes with an unchanged
+    #   resourceVersion are skipped and nodes missing from the list are removed.
+    #
+    # Inputs:
+    #   nodes: Array of V1Node objects
+  # /
+  def syncNodes(self, nodes):
+    seen = set()
+    for node in nodes:
+      seen.add(node.metadata.name)
+      self.refreshNode(node)
+    for nodeName in [n for n in self.nodes if n not in seen]:
+      self.removeNode(nodeName)
+
+  # /
+    # Description: Add or update a single node, e.g. from a GET of the node, skipping it if its resourceVersion has
+    #   not changed.
+    #
+    # Inputs:
+    #   node: V1Node object
+  # /
+  def refreshNode(self, node):
+    if self.nodeVersions.get(node.metadata.name) == node.metadata.resource_version and node.metadata.name in self.nodes:
+      return
+    self.nodeVersions[node.metadata.name] = node.metadata.resource_version
+    self.updateNode(node)
+
+  # /
+    # Description: Add or update a node and move any pods on it between domains if its labels changed.
+    #
+    # Inputs:
+    #   node: V1Node object
+  # /
+  def updateNode(self, node):
+    nodeName = node.metadata.name
+    if nodeName not in self.slots:
+      if self.freeSlots:
+        slot = self.freeSlots.pop()
+        self.nodeArray[slot] = nodeName
+      else:
+        slot = len(self.nodeArray)
+        self.nodeArray.append(nodeName)
+      self.slots[nodeName] = slot
+      self.allMask |= 1 << slot
+    bit = 1 << self.slots[nodeName]
+    if nodeReady(node):
+      self.readyMask |= bit
+    else:
+      self.readyMask &= ~bit
+    self.nodeObjects[nodeName] = node
+    oldLabels = self.nodes.get(nodeName, {})
+    labels = dict(node.metadata.labels or {})
+    self.nodes[nodeName] = labels
+    for key, domains in self.domains.items():
+      oldValue = oldLabels.get(key)
+      newValue = labels.get(key)
+      if oldValue == newValue and (newValue is None or domains.get(newValue, 0) & bit):
+        continue
+      if oldValue is not None:
+        self._clear(domains, oldValue, bit)
+      if newValue is not None:
+        domains[newValue] = domains.get(newValue, 0) | bit
+      self._movePods(nodeName, key, oldValue, newValue)
+
+  # /
+    # Description: Remove a node from the index and free its slot. Pods recorded on it stay until the watch
+    #   removes them.
+    #
+    # Inputs:
+    #   nodeName: Name of the node
+  # /
+  def removeNode(self, nodeName):
+    oldLabels = self.nodes.pop(nodeName, {})
+    self.nodeObjects.pop(nodeName, None)
+    self.nodeVersions.pop(nodeName, None)
+    slot = self.slots.pop(nodeName, None)
+    if slot is None:
+      return
+    bit = 1 << slot
+    for key, domains in self.domains.items():
+      if key in oldLabels:
+        self._clear(domains, oldLabels[key], bit)
+        self._movePods(nodeName, key, oldLabels[key], None)
+    self.allMask &= ~bit
+    self.readyMask &= ~bit
+    self.nodeArray[slot] = None
+    self.freeSlots.append(slot)
+
+  # /
+    # Description: Apply a pod watch event to the index. Only pods assigned to a node and not
+    #   terminated are counted.
+    #
+    # Inputs:
+    #   eventType: ADDED, MODIFIED or DELETED
+    #   pod: V1Pod object
+  # /
+  def updatePod(self, eventType, pod):
+    name = pod.metadata.name
+    nodeName = pod.spec.node_name if pod.spec is not None else None
+    if eventType == 'DELETED' or nodeName is None or (pod.status is not None and pod.status.phase in TERMINATED):
+      self.removePod(name)
+      return
+    self.assumePod(name, nodeName, pod.metadata.labels or {})
+
+  # /
+    # Description: Record a pod as placed on a node, e.g. straight after binding and before the watch
+    #   reports it.
+    #
+    # Inputs:
+    #   name: Name of the pod
+    #   nodeName: Name of the node the pod is placed on
+    #   labels: The pod's labels
+  # /
+  def assumePod(self, name, nodeName, labels):
+    current = self.pods.get(name)
+    if current is not None:
+      if current['node'] == nodeName and current['labels'] == labels:
+        return
+      self.removePod(name)
+    labels = dict(labels)
+    self.pods[name] = {"node": nodeName, "labels": labels}
+    self.nodePods.setdefault(nodeName, set()).add(name)
+    self._countPod(nodeName, labels, 1)
+
+  # /
+    # Description: Remove a pod from the index.
+    #
+    # Inputs:
+    #   name: Name of the pod
+  # /
+  def removePod(self, name):
+    current = self.pods.pop(name, None)
+    if current is None:
+      return
+    podNames = self.nodePods.get(current['node'])
+    if podNames is not None:
+      podNames.discard(name)
+      if not podNames:
+        del self.nodePods[current['node']]
+    self._countPod(current['node'], current['labels'], -1)
+
+  # /
+    # Description: Returns the domain value of a node for a topology key, or None if the node does not have the label.
+    #
+    # Inputs:
+    #   nodeName: Name of the node
+    #   key: Topology key
+  # /
+  def domainOf(self, nodeName, key):
+    return self.nodes.get(nodeName, {}).get(key)
+
+  # /
+    # Description: Returns the bitset of the nodes in a domain.
+    #
+    # Inputs:
+    #   key: Topology key
+    #   value: Domain value
+  # /
+  def domainMask(self, key, value):
+    self.addKey(key)
+    return self.domains[key].get(value, 0)
+
+  # /
+    # Description: Returns the bitset of the nodes that have a topology key, whatever its value.
+    #
+    # Inputs:
+    #   key: Topology key
+  # /
+  def keyMask(self, key):
+    self.addKey(key)
+    mask = 0
+    for domainMask in self.domains[key].values():
+      mask |= domainMask
+    return mask
+
+  # /
+    # Description: Returns the V1Node object in a slot of the node array.
+    #
+    # Inputs:
+    #   slot: Slot of the node
+  # /
+  def nodeAt(self, slot):
+    return self.nodeObjects[self.nodeArray[slot]]
+
+  # /
+    # Description: Returns a dictionary of domain value to the number of pods matching a label selector,
+    #   including domains with no matching pods.
+    #
+    # Inputs:
+    #   key: Topology key
+    #   labelSelector: V1LabelSelector object
+  # /
+  def domainCounts(self, key, labelSelector):
+    self.addKey(key)
+    selector = selectorKey(labelSelector)
+    if selector not in self.counts:
+      self.counts[selector] = {}
+    if key not in self.counts[selector]:
+      self.counts[selector][key] = self._buildCounts(selector, key)
+    return self.counts[selector][key]
+
+  def _buildCounts(self, selector, key):
+    counts = dict((value, 0) for value in self.domains[key])
+    for pod in self.pods.values():
+      value = self.domainOf(pod['node'], key)
+      if value is not None and selectorMatches(selector, pod['labels']):
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+  def _countPod(self, nodeName, labels, delta):
+    for selector, keys in self.counts.items():
+      if not selectorMatches(selector, labels):
+        continue
+      for key, counts in keys.items():
+        value = self.domainOf(nodeName, key)
+        if value is not None:
+          counts[value] = counts.get(value, 0) + delta
+
+  def _movePods(self, nodeName, key, oldValue, newValue):
+    for selector, keys in self.counts.items():
+      if key not in keys:
+        continue
+      counts = keys[key]
+      if newValue is not None:
+        counts.setdefault(newValue, 0)
+      matching = len([p for p in self.nodePods.get(nodeName, ()) if selectorMatches(selector, self.pods[p]['labels'])])
+      if matching == 0:
+        continue
+      if oldValue is not None:
+        counts[oldValue] = counts.get(oldValue, 0) - matching
+      if newValue is not None:
+        counts[newValue] = counts[newValue] + matching
+
+  def _clear(self, domains, value, bit):
+    mask = domains.get(value, 0) & ~bit
+    if mask:
+      domains[value] = mask
+    else:
+      domains.pop(value, None)